@@ -0,0 +1,603 @@
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection, wait
+from pathlib import Path
+from types import ModuleType
+
+import matplotlib as mpl
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+from plot_common import fsync_path
+
+if os.name == "posix":
+    import resource
+
+
+def load_plot_module(plot_py_path: Path, module_name: str) -> ModuleType:
+    # plot.pyをモジュールとして読み込む（plot.pyごとに別のモジュール名にする）
+    # sys.modulesにも登録し，子プロセスでの並列描画などで関数や図をpickleできるようにする
+    spec = importlib.util.spec_from_file_location(module_name, plot_py_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+class BatchPageCollector:
+    # ワーカー内でbatch_pdfの代わりにplot.pyのmainへ渡す（PdfPagesと同じsavefigを持つ）
+    # ページはここでは描画せず，図とその時点のrcParamsをpickleしておき，まとめたpdfを書き出すプロセスで追加する
+    def __init__(self) -> None:
+        self.page_pickle: bytes | None = None
+
+        return
+
+    def savefig(self, figure: Figure) -> None:
+        rc = {key: value for key, value in mpl.rcParams.items() if key != "backend"}
+        self.page_pickle = pickle.dumps((figure, rc))
+
+        return
+
+
+def init_batch_process(data_max_mem_mb: float | None) -> None:
+    # ワーカー・まとめたpdfを書き出すプロセスの開始時の設定
+    # （メモリ上限は，親プロセスが物理メモリの使用量（RSS）を見て確認する）
+    if os.name == "posix":
+        # 親からワーカーを（図の並列描画用の子プロセスごと）まとめて強制終了できるように，プロセスグループを分ける
+        os.setpgrp()
+        if data_max_mem_mb is not None:
+            # 親の確認（0.5秒ごと）が間に合わない急なメモリ確保への備えとして，データ領域の上限（RLIMIT_DATA）も設定する（超える確保はMemoryErrorになる）
+            # 仮想メモリ全体の上限（RLIMIT_AS）と違い，確保の予約だけで使っていない領域（スレッドのスタックの予約など）は数えない
+            data_max_mem_byte = int(data_max_mem_mb * 1024**2)
+            resource.setrlimit(
+                resource.RLIMIT_DATA, (data_max_mem_byte, data_max_mem_byte)
+            )
+
+    return
+
+
+def run_batch_worker(conn: Connection, data_max_mem_mb: float | None) -> None:
+    # ワーカープロセスの本体：親から受け取ったplot.pyを1つずつ描画し，結果を返す
+    init_batch_process(data_max_mem_mb=data_max_mem_mb)
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        idx, plot_py_path = task
+        collector = BatchPageCollector()
+        output_path_list = []
+        status = "ok"
+        message = ""
+        try:
+            module = load_plot_module(
+                plot_py_path=plot_py_path, module_name=f"plot_{idx}"
+            )
+            module.main(batch_pdf=collector, batch_output_path_list=output_path_list)
+        except MemoryError:
+            status = "memory"
+            message = "メモリを確保できませんでした"
+        except Exception as e:  # noqa: BLE001  plot.py内のどんなエラーも，その図だけの失敗として記録する
+            status = "error"
+            message = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+
+        conn.send(
+            {
+                "status": status,
+                "message": message,
+                "page_pickle": collector.page_pickle,
+                "output_path_list": output_path_list,
+            }
+        )
+
+    return
+
+
+def run_batch_pdf_writer(
+    conn: Connection,
+    batch_pdf_path: Path,
+    pdf_compression: int,
+    data_max_mem_mb: float | None,
+) -> None:
+    # まとめたpdfを書き出すプロセスの本体：ワーカーが作った図のpickleを順に受け取り，1ページずつ追加する
+    # ページの描画と（pdfを閉じるときの）フォントの埋め込みもワーカーと同じメモリ上限の下で行い，
+    # 親プロセスでは図をpickleから復元しない
+    # 途中で失敗したpdfは壊れている可能性があるので，失敗を返してそこで終了する
+    init_batch_process(data_max_mem_mb=data_max_mem_mb)
+
+    num_pages = None
+    status = "ok"
+    message = ""
+    try:
+        with (
+            mpl.rc_context({"pdf.compression": pdf_compression}),
+            PdfPages(batch_pdf_path) as batch_pdf,
+        ):
+            while True:
+                task = conn.recv()
+                if task is None:
+                    break
+
+                idx, plot_py_path, page_pickle = task
+                # 図のpickleがplot.py内のクラス等を参照するので，このプロセスにも読み込んでおく（mainは実行しない）
+                load_plot_module(plot_py_path=plot_py_path, module_name=f"plot_{idx}")
+                fig, rc = pickle.loads(page_pickle)
+                with mpl.rc_context(rc):
+                    batch_pdf.savefig(fig)
+                conn.send({"status": "ok", "message": "", "num_pages": None})
+            num_pages = batch_pdf.get_pagecount()
+    except MemoryError:
+        status = "memory"
+        message = "まとめたpdfの書き出しで，メモリを確保できませんでした"
+    except Exception as e:  # noqa: BLE001  どのページのエラーも，まとめたpdfの失敗として親に返す
+        status = "error"
+        message = f"まとめたpdfの書き出しに失敗しました: {type(e).__name__}: {e}"
+        traceback.print_exc()
+
+    conn.send({"status": status, "message": message, "num_pages": num_pages})
+
+    return
+
+
+def start_batch_process(
+    mp_context: multiprocessing.context.BaseContext, target, **target_kwargs
+) -> dict:
+    # ワーカー・まとめたpdfを書き出すプロセスを起動する（targetには，やり取りに使うconnも渡す）
+    parent_conn, child_conn = mp_context.Pipe()
+    process = mp_context.Process(
+        target=target, kwargs={"conn": child_conn, **target_kwargs}
+    )
+    process.start()
+    child_conn.close()
+
+    return {"process": process, "conn": parent_conn, "task": None, "time_start": 0.0}
+
+
+def kill_batch_worker(worker: dict) -> None:
+    # ワーカーを（図の並列描画用の子プロセスごと）強制終了する
+    process = worker["process"]
+    if os.name == "posix":
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # プロセスグループを分ける前に終了した場合
+            process.kill()
+    else:
+        process.kill()
+    process.join()
+    worker["conn"].close()
+
+    return
+
+
+def get_batch_process_rss_mb(worker: dict) -> float:
+    # ワーカー・まとめたpdfを書き出すプロセスと，その子プロセス（図の並列描画用など）の物理メモリ使用量（RSS）の合計 [MB]
+    # （仮想メモリ（予約しただけで使っていない領域を含む）ではなく，実際に使っている量で上限を確認する）
+    # psutilは別プロセスで描画する場合だけ使うので，ここで読み込む（pip install -e ".[batch]"）
+    import psutil
+
+    rss_byte = 0
+    with contextlib.suppress(psutil.NoSuchProcess):
+        process = psutil.Process(worker["process"].pid)
+        for p in [process, *process.children(recursive=True)]:
+            with contextlib.suppress(psutil.NoSuchProcess, psutil.AccessDenied):
+                rss_byte += p.memory_info().rss
+
+    return rss_byte / 1024**2
+
+
+def receive_batch_result(
+    worker: dict, timeout_s: float, max_mem_mb: float, is_ready: bool
+) -> dict | None:
+    # ワーカー・まとめたpdfを書き出すプロセスから結果を受け取る（まだ結果がなく，メモリ・時間の上限内ならNone）
+    # 落ちた・メモリや時間の上限を超えた場合は，その旨の結果を返す
+    if is_ready:
+        try:
+            return worker["conn"].recv()
+        except EOFError:
+            worker["process"].join()
+            return {
+                "status": "crashed",
+                "message": f"プロセスが異常終了しました（終了コード: {worker['process'].exitcode}）",
+            }
+    rss_mb = get_batch_process_rss_mb(worker=worker)
+    if rss_mb > max_mem_mb:
+        return {
+            "status": "memory",
+            "message": f"メモリ使用量（RSS: {rss_mb:.0f} MB）が上限（{max_mem_mb} MB）を超えました",
+        }
+    if time.perf_counter() - worker["time_start"] > timeout_s:
+        return {
+            "status": "timeout",
+            "message": f"描画時間の上限（{timeout_s} s）を超えました",
+        }
+
+    return None
+
+
+def run_batch_isolated(
+    plot_py_path_list: list[Path],
+    batch_pdf_path: Path,
+    pdf_compression: int,
+    batch_output_path_list: list[Path] | None,
+    num_workers: int,
+    worker_max_mem_mb: float,
+    worker_data_max_mem_mb: float | None,
+    worker_timeout_s: float,
+) -> tuple[list[dict], int | None]:
+    # 各図を別プロセス（ワーカー）で描画し，(各図の結果, まとめたpdfのページ数) を返す
+    # メモリ・時間の上限を超えたワーカーは強制終了して新しいものに入れ替え，その図だけを失敗として記録する
+    # （他の図は残りのワーカーで描画を続ける）
+    # まとめたpdfも別プロセスで（ワーカーと同じ上限の下で）書き出し，失敗した場合はページ数をNoneとする
+    if importlib.util.find_spec("psutil") is None:
+        raise RuntimeError(
+            "別プロセスで描画する（is_isolate_workers）には，メモリ使用量の確認にpsutilが必要です"
+            '（pip install -e ".[batch]" でインストールしてください）'
+        )
+    mp_context = multiprocessing.get_context("spawn")
+    task_deque = deque(enumerate(plot_py_path_list))
+    report_list: list[dict | None] = [None] * len(plot_py_path_list)
+    page_pickle_dict: dict[int, bytes] = {}
+    next_page_idx = 0
+    num_pages = None
+
+    worker_list = [
+        start_batch_process(
+            mp_context=mp_context,
+            target=run_batch_worker,
+            data_max_mem_mb=worker_data_max_mem_mb,
+        )
+        for _ in range(min(num_workers, len(plot_py_path_list)))
+    ]
+    pdf_writer = start_batch_process(
+        mp_context=mp_context,
+        target=run_batch_pdf_writer,
+        batch_pdf_path=batch_pdf_path,
+        pdf_compression=pdf_compression,
+        data_max_mem_mb=worker_data_max_mem_mb,
+    )
+    try:
+        while pdf_writer is not None or any(report is None for report in report_list):
+            # 空いているワーカーに次の図を割り当てる
+            for worker in worker_list:
+                if worker["task"] is None and task_deque:
+                    worker["task"] = task_deque.popleft()
+                    worker["time_start"] = time.perf_counter()
+                    worker["conn"].send(worker["task"])
+                    idx, plot_py_path = worker["task"]
+                    print(
+                        f"バッチ実行中 ({idx + 1}/{len(plot_py_path_list)}): {plot_py_path}"
+                    )
+
+            # 描画の終わった図から，順番通りにまとめたpdfへ送る（失敗した図は飛ばす）
+            # 全ての図を送り終えたら，pdfを閉じるよう伝える
+            while (
+                pdf_writer is not None
+                and pdf_writer["task"] is None
+                and (
+                    next_page_idx == len(plot_py_path_list)
+                    or report_list[next_page_idx] is not None
+                )
+            ):
+                pdf_writer["time_start"] = time.perf_counter()
+                if next_page_idx == len(plot_py_path_list):
+                    pdf_writer["task"] = "close"
+                    pdf_writer["conn"].send(None)
+                    break
+                page_pickle = page_pickle_dict.pop(next_page_idx, None)
+                if page_pickle is not None:
+                    # 親プロセスでは図を復元せず，pickleのまま渡す
+                    pdf_writer["task"] = next_page_idx
+                    pdf_writer["conn"].send(
+                        (next_page_idx, plot_py_path_list[next_page_idx], page_pickle)
+                    )
+                next_page_idx += 1
+
+            # 結果が返る（またはプロセスが落ちる）まで，メモリ使用量・タイムアウトの確認を挟みながら待つ
+            busy_worker_list = [
+                w
+                for w in [*worker_list, pdf_writer]
+                if w is not None and w["task"] is not None
+            ]
+            ready_conn_list = wait([w["conn"] for w in busy_worker_list], timeout=0.5)
+            for worker_idx, worker in enumerate(worker_list):
+                if worker["task"] is None:
+                    continue
+                result = receive_batch_result(
+                    worker=worker,
+                    timeout_s=worker_timeout_s,
+                    max_mem_mb=worker_max_mem_mb,
+                    is_ready=worker["conn"] in ready_conn_list,
+                )
+                if result is None:
+                    continue
+
+                idx, plot_py_path = worker["task"]
+                report_list[idx] = {
+                    "index": idx,
+                    "plot_py": str(plot_py_path),
+                    "status": result["status"],
+                    "elapsed_s": round(time.perf_counter() - worker["time_start"], 3),
+                    "message": result["message"],
+                }
+                if result.get("page_pickle") is not None and pdf_writer is not None:
+                    page_pickle_dict[idx] = result["page_pickle"]
+                if batch_output_path_list is not None:
+                    batch_output_path_list.extend(result.get("output_path_list", []))
+                worker["task"] = None
+
+                # 上限を超えた・落ちたワーカーは使い回さず，新しいものに入れ替える
+                if result["status"] in ("memory", "timeout", "crashed"):
+                    print(f"ワーカーを入れ替えます ({idx + 1}): {result['message']}")
+                    kill_batch_worker(worker=worker)
+                    if task_deque:
+                        worker_list[worker_idx] = start_batch_process(
+                            mp_context=mp_context,
+                            target=run_batch_worker,
+                            data_max_mem_mb=worker_data_max_mem_mb,
+                        )
+
+            if pdf_writer is None or pdf_writer["task"] is None:
+                continue
+            result = receive_batch_result(
+                worker=pdf_writer,
+                timeout_s=worker_timeout_s,
+                max_mem_mb=worker_max_mem_mb,
+                is_ready=pdf_writer["conn"] in ready_conn_list,
+            )
+            if result is None:
+                continue
+            if result["status"] != "ok":
+                # まとめたpdfは中止し，残りの図の描画・各図の出力は最後まで続ける
+                page = (
+                    "pdfを閉じる処理"
+                    if pdf_writer["task"] == "close"
+                    else f"{pdf_writer['task'] + 1} 番目の図のページ"
+                )
+                print(f"まとめたpdfを中止します（{page}）: {result['message']}")
+                kill_batch_worker(worker=pdf_writer)
+                pdf_writer = None
+                page_pickle_dict.clear()
+            elif pdf_writer["task"] == "close":
+                num_pages = result["num_pages"]
+                pdf_writer["process"].join(timeout=10)
+                kill_batch_worker(worker=pdf_writer)
+                pdf_writer = None
+            else:
+                pdf_writer["task"] = None
+    finally:
+        for worker in worker_list:
+            if worker["process"].is_alive() and worker["task"] is None:
+                worker["conn"].send(None)
+                worker["process"].join(timeout=10)
+            kill_batch_worker(worker=worker)
+        if pdf_writer is not None:
+            kill_batch_worker(worker=pdf_writer)
+
+    return report_list, num_pages
+
+
+class RenderDigestCollector:
+    # ストレステスト用：batch_pdfの代わりにplot.pyのmainへ渡し，描画結果（RGBAの画素）のハッシュだけを記録する
+    def __init__(self) -> None:
+        self.digest: str | None = None
+
+        return
+
+    def savefig(self, figure: Figure) -> None:
+        buf = io.BytesIO()
+        figure.savefig(buf, format="rgba")
+        self.digest = hashlib.sha256(buf.getvalue()).hexdigest()
+
+        return
+
+
+def render_digest(module: ModuleType) -> str:
+    collector = RenderDigestCollector()
+    module.main(batch_pdf=collector, batch_output_path_list=[])
+
+    return collector.digest
+
+
+def run_stress_test(
+    plot_py_path_list: list[Path], num_renders: int, num_threads: int
+) -> bool:
+    # 各plot.pyの図をスレッドで並行して大量に描画し，1枚ずつ描画した結果と画素単位で一致するか確認する
+    # （各図の出力ファイルも毎回書き出すので，同じ出力への並行した書き出しも確認される）
+    module_list = [
+        load_plot_module(plot_py_path=plot_py_path, module_name=f"plot_{idx}")
+        for idx, plot_py_path in enumerate(plot_py_path_list)
+    ]
+    module_idx_list = [idx % len(module_list) for idx in range(num_renders)]
+
+    def render(module_idx: int) -> str:
+        return render_digest(module=module_list[module_idx])
+
+    # 各plot.pyのprintは捨てる
+    with contextlib.redirect_stdout(io.StringIO()):
+        time_start = time.perf_counter()
+        ref_digest_list = [render_digest(module=module) for module in module_list]
+        time_serial = time.perf_counter() - time_start
+
+        time_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            digest_list = list(executor.map(render, module_idx_list))
+        time_concurrent = time.perf_counter() - time_start
+
+    mismatch_list = [
+        (module_idx, digest)
+        for module_idx, digest in zip(module_idx_list, digest_list)
+        if digest != ref_digest_list[module_idx]
+    ]
+    print(
+        f"ストレステスト: {num_renders} 回を {num_threads} スレッドで並行描画，"
+        f"不一致 {len(mismatch_list)} 回"
+    )
+    print(
+        f"  1図あたり: 逐次 {time_serial / len(module_list) * 1e3:.0f} ms，"
+        f"並行 {time_concurrent / num_renders * 1e3:.0f} ms"
+    )
+    for module_idx in sorted({module_idx for module_idx, _ in mismatch_list}):
+        print(f"  不一致: {plot_py_path_list[module_idx]}")
+
+    return not mismatch_list
+
+
+def main() -> None:
+    # ! ---↓基本設定------------------------------------------------
+    # *---バッチで実行するplot.pyの一覧---
+    plot_py_path_list = [
+        Path(__file__).parent / "sample1" / "plot.py",
+        Path(__file__).parent / "sample2" / "plot.py",
+        Path(__file__).parent / "sample3" / "plot.py",
+        # Path(__file__).parent / "sample4" / "plot.py",  # 素データ（output_sample.dat）が同梱されていないので除外
+    ]
+    # *---バッチで実行するplot.pyの一覧---
+
+    # *---全図をまとめたpdfの設定---
+    # 各plot.pyの出力に加えて，全図を1ページずつまとめたpdfを保存する（フォントは全ページで共有される）
+    batch_pdf_filename = "batch_res.pdf"  # 保存名
+    pdf_compression = 6  # pdfの圧縮レベル（0~9）
+    # *---全図をまとめたpdfの設定---
+
+    # *---出力の書き込み設定---
+    is_fsync_per_batch = True  # 各図の出力のfsyncを，図ごとではなくバッチの最後にまとめて行うか（Falseなら各plot.pyの設定に従う）
+    # *---出力の書き込み設定---
+
+    # *---ワーカープロセスの設定---
+    # 各図を別プロセス（ワーカー）で描画し，メモリ・時間の上限を超えた図だけを失敗として打ち切る
+    # （巨大なデータや暴走したmathtextなどで，バッチ全体やマシンが巻き添えにならないようにする）
+    is_isolate_workers = True  # Falseなら全図をこのプロセス内で順に描画する（上限なし）
+    num_workers = 2  # 同時に描画するワーカー数
+    worker_max_mem_mb = 4096  # 1ワーカーあたりのメモリ上限 [MB]（子プロセスを含む物理メモリの使用量（RSS）の合計を0.5秒ごとに確認する）
+    worker_data_max_mem_mb = None  # 確認の間に急に確保されるメモリへの備えとして，各プロセスに設定するデータ領域の上限 [MB]（RLIMIT_DATA，POSIXのみ．Noneなら設定しない）
+    worker_timeout_s = 600  # 1図あたりの描画時間の上限 [s]
+    # *---ワーカープロセスの設定---
+
+    # *---並行描画のストレステスト---
+    is_stress_test = False  # Trueなら，バッチ実行の代わりに各plot.pyの図をスレッドで並行して大量に描画し，1枚ずつ描画した結果と一致するか確認する
+    num_stress_renders = 200  # 並行して描画する回数（全plot.pyの合計）
+    num_stress_threads = 8  # 描画に使うスレッド数
+    # *---並行描画のストレステスト---
+    # ! ---↑基本設定------------------------------------------------
+
+    if is_stress_test:
+        if not run_stress_test(
+            plot_py_path_list=plot_py_path_list,
+            num_renders=num_stress_renders,
+            num_threads=num_stress_threads,
+        ):
+            sys.exit(1)
+        return
+
+    output_dir_path = Path(__file__).parent / "batch_result"
+    output_dir_path.mkdir(exist_ok=True)
+    # まとめたpdfは一時ファイルに書き出し，全図の描画が終わってから置き換える
+    # （途中で止まっても書きかけのpdfが残らない）
+    batch_pdf_path = output_dir_path / batch_pdf_filename
+    tmp_batch_pdf_path = output_dir_path / f".tmp_{os.getpid()}" / batch_pdf_filename
+    tmp_batch_pdf_path.parent.mkdir(exist_ok=True)
+    # 各図の出力のうち，まだfsyncしていないもの
+    batch_output_path_list = [] if is_fsync_per_batch else None
+    report_list = None
+
+    # 図は1枚ずつ描画してすぐにpdfへ書き出し・破棄するので，図の枚数が増えてもメモリ使用量は増えない
+    if is_isolate_workers:
+        report_list, num_pages = run_batch_isolated(
+            plot_py_path_list=plot_py_path_list,
+            batch_pdf_path=tmp_batch_pdf_path,
+            pdf_compression=pdf_compression,
+            batch_output_path_list=batch_output_path_list,
+            num_workers=num_workers,
+            worker_max_mem_mb=worker_max_mem_mb,
+            worker_data_max_mem_mb=worker_data_max_mem_mb,
+            worker_timeout_s=worker_timeout_s,
+        )
+    else:
+        with (
+            mpl.rc_context({"pdf.compression": pdf_compression}),
+            PdfPages(tmp_batch_pdf_path) as batch_pdf,
+        ):
+            for idx, plot_py_path in enumerate(plot_py_path_list):
+                print(
+                    f"バッチ実行中 ({idx + 1}/{len(plot_py_path_list)}): {plot_py_path}"
+                )
+                module = load_plot_module(
+                    plot_py_path=plot_py_path, module_name=f"plot_{idx}"
+                )
+                module.main(
+                    batch_pdf=batch_pdf, batch_output_path_list=batch_output_path_list
+                )
+
+            num_pages = batch_pdf.get_pagecount()
+
+    # 各図の結果（成功・失敗とその理由）をjsonにも保存する
+    # まとめたpdfを中止した場合は，書きかけのpdfを置かない（前回のpdfが残る）
+    tmp_path_list = [tmp_batch_pdf_path]
+    if num_pages is None:
+        tmp_batch_pdf_path.unlink(missing_ok=True)
+        tmp_path_list = []
+    report_path = output_dir_path / "batch_report.json"
+    if report_list is not None:
+        tmp_report_path = tmp_batch_pdf_path.parent / report_path.name
+        tmp_report_path.write_text(
+            json.dumps(report_list, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        tmp_path_list.append(tmp_report_path)
+
+    # 全図の出力とまとめたpdfのfsyncを一度に行う
+    time_start = time.perf_counter()
+    output_path_list = [
+        *(batch_output_path_list or []),
+        *(output_dir_path / path.name for path in tmp_path_list),
+    ]
+    for path in [*(batch_output_path_list or []), *tmp_path_list]:
+        fsync_path(path)
+    for path in tmp_path_list:
+        os.replace(path, output_dir_path / path.name)
+    tmp_batch_pdf_path.parent.rmdir()
+    for dir_path in {path.parent for path in output_path_list}:
+        fsync_path(dir_path)
+    print(
+        f"fsync完了: {len(output_path_list)} 個，"
+        f"{(time.perf_counter() - time_start) * 1e3:.1f} ms"
+    )
+
+    if num_pages is None:
+        print(f"まとめたpdfは出力されませんでした: {batch_pdf_path}")
+    else:
+        print(f"バッチ出力完了: {batch_pdf_path}（{num_pages}ページ）")
+
+    if report_list is not None:
+        failed_report_list = [r for r in report_list if r["status"] != "ok"]
+        print(
+            f"バッチ結果: 成功 {len(report_list) - len(failed_report_list)} 個，"
+            f"失敗 {len(failed_report_list)} 個（{report_path}）"
+        )
+        for report in failed_report_list:
+            print(
+                f"  失敗 [{report['status']}] {report['plot_py']}: {report['message']}"
+            )
+        if failed_report_list or num_pages is None:
+            sys.exit(1)
+
+    return
+
+
+if __name__ == "__main__":
+    main()
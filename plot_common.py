@@ -0,0 +1,3176 @@
+# 各plot.py（図ごとのテンプレート）とbatch_plot.pyで共通の処理
+# plot.pyからは，基本設定以外の処理（読み込み・描画・保存・キャッシュなど）をここから読み込んで使う
+import atexit
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from types import MappingProxyType
+from typing import ClassVar
+
+import matplotlib as mpl
+import matplotlib.style as mplstyle
+import matplotlib.ticker as ticker
+import numpy as np
+from matplotlib import font_manager, ft2font
+from matplotlib.axes import Axes
+from matplotlib.backend_bases import FigureCanvasBase
+from matplotlib.backends import backend_pdf
+from matplotlib.backends.backend_agg import FigureCanvasAgg, RendererAgg
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.figure import Figure
+from matplotlib.legend_handler import HandlerLine2D, HandlerPathCollection
+from matplotlib.lines import Line2D
+from matplotlib.mathtext import MathTextParser, RasterParse, VectorParse
+from matplotlib.transforms import Bbox
+
+# mathtextの解析器はプロセス全体で1つだけ（MathTextParser._parser）で，解析中の状態を持つので，
+# 複数のスレッドから同時に解析しないようにする
+mathtext_parse_lock = threading.RLock()
+
+
+def enable_mathtext_parse_lock() -> None:
+    # MathTextParser.parseを，ロックを取ってから解析するものに差し替える
+    if getattr(MathTextParser.parse, "is_locked", False):
+        return
+
+    parse_orig = MathTextParser.parse
+
+    def parse(self, s, dpi=72, prop=None, *, antialiased=None):
+        with mathtext_parse_lock:
+            return parse_orig(self, s, dpi, prop, antialiased=antialiased)
+
+    parse.is_locked = True
+    MathTextParser.parse = parse
+
+    return
+
+
+def get_fontlist_digest() -> str:
+    # 使えるフォントの一覧のハッシュ（フォントの追加・削除でフォントの解決結果が変わった場合に，キャッシュを別のキーにする）
+    return hashlib.sha256(
+        "\n".join(
+            sorted(font.fname for font in font_manager.fontManager.ttflist)
+        ).encode()
+    ).hexdigest()
+
+
+# mathtextのキャッシュとして残すファイル数の上限（古く使われていないものから削除する）
+mathtext_cache_max_files = 8192
+# メモリ上に持つmathtextのキャッシュの数の上限（最後に使われたのが古いものから削除する）
+mathtext_cache_max_items = 4096
+# ディスクのキャッシュの整理は，書き込みのこの回数ごとに1回行う（書き込むたびにフォルダ全体を調べないように）
+mathtext_cache_prune_interval = 64
+
+
+def enable_mathtext_disk_cache(cache_dir_path: Path) -> None:
+    # mathtextの解析・レイアウト結果をディスクに保存し，プロセスをまたいで使いまわす
+    # （公開メソッドのMathTextParser.parseを差し替え，戻り値の公開の型VectorParse（svg・pdfなど）・RasterParse（png・jpegなど）を保存する．
+    # キーはmatplotlibのバージョン・出力の種類・数式の文字列・フォント設定・サイズ・dpi・アンチエイリアス）
+    # matplotlibの更新で戻り値の形が変わっても，キーにバージョンを含むので古いキャッシュは使われず，
+    # 知らない形の戻り値は保存しない（読み込めないキャッシュは無視して解析し直す）
+    if getattr(MathTextParser.parse, "is_disk_cached", False):
+        return
+
+    cache_dir_path.mkdir(parents=True, exist_ok=True)
+    prune_cache_dir(
+        cache_dir_path=cache_dir_path,
+        pattern="*.pickle",
+        max_files=mathtext_cache_max_files,
+    )
+    parse_orig = MathTextParser.parse
+    # メモリ上にも，ディスクと同じくフォントをファイルのパスとして持つ
+    # （FT2Fontは描画時にサイズ等を書き換えられるので，スレッドをまたいで共有しない．
+    # 使うたびにfont_manager.get_font（スレッドごとにフォントを持つ）で今のスレッドのフォントに戻す）
+    memory_cache: OrderedDict[str, tuple] = OrderedDict()
+    memory_cache_lock = threading.Lock()
+    write_counter = itertools.count(1)
+    fontlist_digest = get_fontlist_digest()
+
+    def add_memory_cache(cache_key: str, cached: tuple) -> None:
+        with memory_cache_lock:
+            memory_cache[cache_key] = cached
+            memory_cache.move_to_end(cache_key)
+            while len(memory_cache) > mathtext_cache_max_items:
+                memory_cache.popitem(last=False)
+
+        return
+
+    def to_cached(result) -> tuple | None:
+        # 解析結果を，pickleできる形（出力の種類と各要素）にする（保存できないものはNone）
+        if type(result) is RasterParse:
+            ox, oy, width, height, depth, image = result
+            if not isinstance(image, np.ndarray):
+                return None
+            return ("raster", (ox, oy, width, height, depth, image))
+        if type(result) is VectorParse:
+            width, height, depth, glyphs, rects = result
+            # FT2Fontはpickleできないので，フォントファイルのパスとして保存
+            # （パスから同じフォントに戻せない，フォントコレクション内の2つ目以降のフォントを使う数式はキャッシュしない）
+            if not all(
+                isinstance(font, ft2font.FT2Font) and font.face_index == 0
+                for font, *_ in glyphs
+            ):
+                return None
+            glyphs = [(font.fname, *glyph) for font, *glyph in glyphs]
+            return ("vector", (width, height, depth, glyphs, rects))
+
+        return None
+
+    def from_cached(cached: tuple):
+        output_type, fields = cached
+        if output_type == "raster":
+            return RasterParse(*fields)
+        width, height, depth, glyphs, rects = fields
+        return VectorParse(
+            width,
+            height,
+            depth,
+            [(font_manager.get_font(fname), *glyph) for fname, *glyph in glyphs],
+            rects,
+        )
+
+    def parse(self, s, dpi=72, prop=None, *, antialiased=None):
+        output_type = getattr(self, "_output_type", None)
+        if output_type not in ("vector", "raster"):
+            return parse_orig(self, s, dpi, prop, antialiased=antialiased)
+
+        prop_key = None
+        if prop is not None:
+            prop_key = (
+                tuple(prop.get_family()),
+                prop.get_style(),
+                prop.get_variant(),
+                prop.get_weight(),
+                prop.get_stretch(),
+                prop.get_size_in_points(),
+                prop.get_math_fontfamily(),
+                prop.get_file(),
+            )
+        # text.antialiased・text.hinting（ラスターの出力を変える設定）も含む
+        rc_key = sorted(
+            (key, val)
+            for key, val in mpl.rcParams.items()
+            if key.startswith(("mathtext.", "font.", "text."))
+        )
+        cache_key = hashlib.sha256(
+            repr(
+                (
+                    mpl.__version__,
+                    fontlist_digest,
+                    output_type,
+                    s,
+                    dpi,
+                    antialiased,
+                    prop_key,
+                    rc_key,
+                )
+            ).encode()
+        ).hexdigest()
+
+        with memory_cache_lock:
+            cached = memory_cache.get(cache_key)
+            if cached is not None:
+                memory_cache.move_to_end(cache_key)
+        if cached is not None:
+            return from_cached(cached=cached)
+
+        cache_path = cache_dir_path / f"{cache_key}.pickle"
+        if cache_path.exists():
+            # 壊れた・形の違うキャッシュは使わずに解析し直す
+            with contextlib.suppress(Exception):
+                cached = pickle.loads(cache_path.read_bytes())
+                if cached[0] == "raster" or all(
+                    os.path.exists(fname) for fname, *_ in cached[1][3]
+                ):
+                    result = from_cached(cached=cached)
+                    add_memory_cache(cache_key=cache_key, cached=cached)
+                    # 使ったキャッシュは新しいものとして残す
+                    os.utime(cache_path)
+                    return result
+
+        result = parse_orig(self, s, dpi, prop, antialiased=antialiased)
+        cached = to_cached(result)
+        if cached is not None:
+            add_memory_cache(cache_key=cache_key, cached=cached)
+            # 他のプロセスが読みかけのファイルを上書きしないよう，一時ファイルに書いてから置き換える
+            with tempfile.NamedTemporaryFile(dir=cache_dir_path, delete=False) as f:
+                pickle.dump(cached, f)
+            os.replace(f.name, cache_path)
+            if next(write_counter) % mathtext_cache_prune_interval == 0:
+                prune_cache_dir(
+                    cache_dir_path=cache_dir_path,
+                    pattern="*.pickle",
+                    max_files=mathtext_cache_max_files,
+                )
+
+        return result
+
+    parse.is_disk_cached = True
+    parse.is_locked = getattr(parse_orig, "is_locked", False)
+    MathTextParser.parse = parse
+
+    return
+
+
+def init_mpl_process(is_use_mathtext_disk_cache: bool) -> None:
+    # プロセス全体に1回だけ行えばよい設定（既に行っていれば何もしない）
+    mpl.use("Agg")
+    enable_mathtext_parse_lock()
+    if is_use_mathtext_disk_cache:
+        enable_mathtext_disk_cache(
+            cache_dir_path=Path(mpl.get_cachedir()) / "mathtext_cache"
+        )
+
+    return
+
+
+# 検証済みのスタイル（設定の内容 -> スタイル）
+plot_style_cache: dict[str, MappingProxyType] = {}
+
+
+def compile_plot_style(
+    is_use_TimesNewRoman_in_mathtext: bool,
+    axis_lw: float,
+    is_plot_mticks_x: bool,
+    is_plot_mticks_y: bool,
+    plot_rc: dict,
+) -> MappingProxyType:
+    # 図のスタイル（rcParamsの変更分）を，検証済みで変更できない辞書にまとめる
+    # use_plot_style(style)で図の描画中だけ適用するので，同じプロセスで続けて描く図に設定が漏れない
+    style = {
+        # 描画高速化
+        **mplstyle.library["fast"],
+        # svg用の設定
+        "svg.fonttype": "none",
+        # MatplotlibのデフォルトフォントをTimes New Romanに設定
+        "font.family": "Times New Roman",
+    }
+
+    # mathtext関連
+    if is_use_TimesNewRoman_in_mathtext:
+        style["mathtext.fontset"] = "custom"
+        style["mathtext.it"] = "Times New Roman:italic"
+        style["mathtext.bf"] = "Times New Roman:bold"
+        style["mathtext.bfit"] = "Times New Roman:italic:bold"
+        style["mathtext.rm"] = "Times New Roman"
+        style["mathtext.fallback"] = "cm"
+    else:
+        style["mathtext.fontset"] = "cm"
+
+    # x軸,y軸の目盛りの向き
+    style["xtick.direction"] = "out"
+    style["ytick.direction"] = "out"
+
+    # 軸関係
+    style["axes.linewidth"] = axis_lw
+    style["xtick.minor.visible"] = is_plot_mticks_x
+    style["ytick.minor.visible"] = is_plot_mticks_y
+
+    # 凡例の見た目設定
+    style["legend.fancybox"] = False  # 丸角OFF
+    style["legend.framealpha"] = 1  # 透明度の指定、0で塗りつぶしなし
+    style["legend.edgecolor"] = "black"  # edgeの色を変更
+
+    # main内の基本設定での変更
+    style.update(plot_rc)
+
+    # 同じ設定のスタイルは1回だけ検証し，以降は使いまわす（不正な値はここでエラーになる）
+    cache_key = repr(sorted(style.items()))
+    if cache_key not in plot_style_cache:
+        plot_style_cache[cache_key] = MappingProxyType(dict(mpl.RcParams(style)))
+
+    return plot_style_cache[cache_key]
+
+
+# 適用中のスタイルと，それを使って描画中の図の数
+plot_style_state = {"style": None, "num_figs": 0, "rc_context": None}
+plot_style_condition = threading.Condition()
+
+
+@contextlib.contextmanager
+def use_plot_style(style: MappingProxyType):
+    # mpl.rc_context(style)と同じく，styleを適用して抜けると元のrcParamsに戻す（スレッドから並行して使える）
+    # rcParamsはプロセス全体で1つなので，同じスタイルの図は並行して描画し，
+    # 違うスタイルの図は，描画中の図が全て終わってから適用する
+    with plot_style_condition:
+        while plot_style_state["num_figs"] and plot_style_state["style"] != style:
+            plot_style_condition.wait()
+        if not plot_style_state["num_figs"]:
+            plot_style_state["style"] = style
+            plot_style_state["rc_context"] = mpl.rc_context(style)
+            plot_style_state["rc_context"].__enter__()
+        plot_style_state["num_figs"] += 1
+
+    try:
+        yield
+    finally:
+        with plot_style_condition:
+            plot_style_state["num_figs"] -= 1
+            if not plot_style_state["num_figs"]:
+                plot_style_state["rc_context"].__exit__(None, None, None)
+                plot_style_state["style"] = None
+                plot_style_state["rc_context"] = None
+                plot_style_condition.notify_all()
+
+
+def update_legend_line(
+    legend_handle: Line2D, orig_handle: Line2D, linewidth: float
+) -> None:
+    # 凡例のlineに元の線の見た目をコピーしてから，線の太さだけを統一する
+    legend_handle.update_from(orig_handle)
+    legend_handle.set_linewidth(linewidth)
+
+    return
+
+
+def get_legend_handler_map(
+    legend_lines_lw: float | None, legend_scatters_size: float | None
+) -> dict:
+    # 凡例のline・scatterの大きさを統一するハンドラ（ax.legendのhandler_mapに渡す）
+    # 凡例を作る時点で最終的な大きさになるので，作った後に書き換えてレイアウトを計算し直す必要がない
+    # （図をpickleしてもハンドラを復元できるよう，lambdaではなくモジュールの関数を使う）
+    handler_map = {}
+    if legend_lines_lw is not None:
+        handler_map[Line2D] = HandlerLine2D(
+            update_func=functools.partial(update_legend_line, linewidth=legend_lines_lw)
+        )
+    if legend_scatters_size is not None:
+        handler_map[PathCollection] = HandlerPathCollection(
+            sizes=[legend_scatters_size]
+        )
+
+    return handler_map
+
+
+def set_fig_ax(
+    fig_horizontal_cm: float, fig_vertical_cm: float, dpi: int, is_aspect_equal: bool
+) -> tuple[Figure, Axes]:
+    scaler_cm_to_inch = 1 / 2.54
+
+    # pyplotを使わずに図を作る（pyplotの図の一覧に登録されないので，複数のスレッドで別々の図を描画・保存できる）
+    fig = Figure(
+        figsize=(
+            fig_horizontal_cm * scaler_cm_to_inch,
+            fig_vertical_cm * scaler_cm_to_inch,
+        ),
+        dpi=dpi,
+        layout="constrained",
+    )
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    if is_aspect_equal:
+        ax.set_aspect("equal")
+
+    return fig, ax
+
+
+class LayoutCanvas(FigureCanvasBase):
+    # レイアウト計算（文字の大きさなどの計算）専用のキャンバス
+    # FigureCanvasAggのget_renderer()は図全体の大きさの描画バッファを確保・初期化するので，
+    # 1画素分のバッファのレンダラーで代用する（文字の大きさはdpiだけで決まるので，計算結果は同じ）
+    def __init__(self, figure: Figure) -> None:
+        super().__init__(figure)
+        self.renderer = RendererAgg(1, 1, figure.dpi)
+
+    def get_renderer(self) -> RendererAgg:
+        return self.renderer
+
+
+def execute_layout(fig: Figure) -> None:
+    # 描画せずにレイアウト計算だけ行う（計算中だけキャンバスを差し替える）
+    canvas = fig.canvas
+    LayoutCanvas(fig)  # 作成するとfig.canvasが差し替わる
+    fig.get_layout_engine().execute(fig)
+    fig.set_canvas(canvas)
+
+    return
+
+
+# 軸の位置のキャッシュとして残すファイル数の上限（古く使われていないものから削除する）
+layout_cache_max_files = 256
+
+
+def prune_layout_cache(layout_cache_dir_path: Path) -> None:
+    prune_cache_dir(
+        cache_dir_path=layout_cache_dir_path,
+        pattern="*.json",
+        max_files=layout_cache_max_files,
+    )
+
+    return
+
+
+def prune_cache_dir(cache_dir_path: Path, pattern: str, max_files: int) -> None:
+    # キャッシュのファイル（patternに一致するもの）がmax_filesを超えたら，最後に使われた（更新された）のが古いものから削除する
+    # （キャッシュを読み込んだときにos.utimeで更新日時を新しくしておく）
+    cache_path_list = []
+    for cache_path in cache_dir_path.glob(pattern):
+        try:
+            cache_path_list.append((cache_path.stat().st_mtime_ns, cache_path))
+        except FileNotFoundError:
+            # 他のプロセスが削除した場合
+            continue
+    cache_path_list.sort()
+    for _, cache_path in cache_path_list[: -max_files or None]:
+        cache_path.unlink(missing_ok=True)
+
+    return
+
+
+@functools.cache
+def get_plot_common_digest() -> str:
+    # このファイルの内容のハッシュ（共通の処理を修正した場合に，キャッシュを別のキーにする）
+    return hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+
+@contextlib.contextmanager
+def pin_ax_position(
+    fig: Figure,
+    ax: Axes,
+    output_kind: str,
+    layout_cache_dir_path: Path | None,
+    layout_key: dict,
+):
+    # constrained layoutで決まる軸の位置を固定して，この中での保存ではレイアウト計算を省く（抜けるとconstrained layoutに戻す）
+    # 文字の大きさはレンダラーごとに（ラスターはdpiのヒンティング込み，ベクターは72dpiで）わずかに違い，軸の位置も変わるので，
+    # 位置は出力の種類（output_kind："raster"か，"svg"・"pdf"などの拡張子）ごとに求めてキャッシュする
+    # - ラスター：描画せずに，保存と同じdpiのAggのレンダラーでレイアウト計算だけ行う
+    # - ベクター：最初の1回はそのままconstrained layoutで保存し，保存後の軸の位置をキャッシュする
+    # 同じ設定（layout_key・共通の処理・図の大きさ・dpi・表示範囲・rcParams・使えるフォント）での位置はキャッシュから読み込む
+    # layout_cache_dir_pathがNoneなら固定しない
+    if layout_cache_dir_path is None:
+        yield
+        return
+
+    layout_key = {
+        **layout_key,
+        "output_kind": output_kind,
+        "plot_common": get_plot_common_digest(),
+        "matplotlib": mpl.__version__,
+        "fontlist": get_fontlist_digest(),
+        "figsize": fig.get_size_inches().tolist(),
+        "dpi": fig.dpi,
+        "xlim": ax.get_xlim(),
+        "ylim": ax.get_ylim(),
+        "scale": (ax.get_xscale(), ax.get_yscale()),
+        "rcparams": sorted(mpl.rcParams.items()),
+    }
+    cache_key = hashlib.sha256(repr(layout_key).encode()).hexdigest()
+    layout_cache_path = layout_cache_dir_path / f"{cache_key}.json"
+
+    def write_layout_cache(position: list[float]) -> None:
+        layout_cache_dir_path.mkdir(parents=True, exist_ok=True)
+        # 他のスレッド・プロセスが読みかけのファイルを上書きしないよう，一時ファイルに書いてから置き換える
+        with tempfile.NamedTemporaryFile(
+            "w", dir=layout_cache_dir_path, delete=False
+        ) as f:
+            f.write(json.dumps(position))
+        os.replace(f.name, layout_cache_path)
+        prune_layout_cache(layout_cache_dir_path=layout_cache_dir_path)
+
+        return
+
+    layout_engine = fig.get_layout_engine()
+    try:
+        position = json.loads(layout_cache_path.read_text())
+        # 使ったキャッシュは新しいものとして残す
+        os.utime(layout_cache_path)
+        print(
+            f"軸の位置をキャッシュから読み込み（{output_kind}）: {layout_cache_path.name}"
+        )
+    except FileNotFoundError:
+        if output_kind != "raster":
+            # 保存時のconstrained layoutで決まった位置を，次回以降のためにキャッシュする
+            yield
+            write_layout_cache(position=ax.get_position(original=True).extents.tolist())
+            return
+
+        execute_layout(fig)
+        position = ax.get_position(original=True).extents.tolist()
+        write_layout_cache(position=position)
+
+    # ax.set_positionは軸をレイアウトの対象から外すので，抜けるときに戻す
+    is_in_layout = ax.get_in_layout()
+    fig.set_layout_engine("none")
+    # 位置は四隅の座標（x0, y0, x1, y1）で持つ（幅・高さから戻すと丸め誤差で，svgのclip-pathのidなどが変わる）
+    ax.set_position(Bbox.from_extents(*position))
+    try:
+        yield
+    finally:
+        fig.set_layout_engine(layout_engine)
+        ax.set_in_layout(is_in_layout)
+
+    return
+
+
+def set_ax_lim(ax: Axes, xmin: float, xmax: float, ymin: float, ymax: float) -> None:
+    ax.set_xlim(xmin, xmax)
+    ax.set_ylim(ymin, ymax)
+
+    return
+
+
+class CachedLocator(ticker.Locator):
+    # 同じ設定・表示範囲での目盛り位置の計算結果を，図をまたいで使いまわす（スイープ描画で同じ範囲を何度も描く場合など）
+    # キャッシュは全インスタンスで共有し，tick_cache_max_items個を超えたら最後に使われたのが古いものから削除する
+    tick_cache: ClassVar[OrderedDict[tuple, np.ndarray]] = OrderedDict()
+    tick_cache_max_items: ClassVar[int] = 4096
+    tick_cache_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, locator: ticker.Locator, cache_key: tuple) -> None:
+        self.locator = locator
+        self.cache_key = cache_key
+
+    def set_axis(self, axis) -> None:
+        super().set_axis(axis)
+        self.locator.set_axis(axis)
+
+    def __call__(self) -> np.ndarray:
+        vmin, vmax = self.axis.get_view_interval()
+        # 目盛り数が自動の場合（LogLocatorなど）は軸の長さとフォントサイズにも依存する
+        key = (self.cache_key, vmin, vmax, self.axis.get_tick_space())
+        with CachedLocator.tick_cache_lock:
+            if key in CachedLocator.tick_cache:
+                CachedLocator.tick_cache.move_to_end(key)
+                return CachedLocator.tick_cache[key]
+
+        ticks = self.locator()
+        with CachedLocator.tick_cache_lock:
+            CachedLocator.tick_cache[key] = ticks
+            while len(CachedLocator.tick_cache) > CachedLocator.tick_cache_max_items:
+                CachedLocator.tick_cache.popitem(last=False)
+
+        return ticks
+
+    def tick_values(self, vmin: float, vmax: float) -> np.ndarray:
+        return self.locator.tick_values(vmin, vmax)
+
+    def nonsingular(self, v0: float, v1: float) -> tuple[float, float]:
+        return self.locator.nonsingular(v0, v1)
+
+    def view_limits(self, vmin: float, vmax: float) -> tuple[float, float]:
+        return self.locator.view_limits(vmin, vmax)
+
+
+class CachedFormatter(ticker.Formatter):
+    # 同じ設定・表示範囲・目盛り位置での目盛りラベル文字列を，図をまたいで使いまわす
+    # （文字列が毎回同じになるので，Matplotlib側のテキスト寸法・mathtextのキャッシュにも当たりやすくなる）
+    # キャッシュは全インスタンスで共有し，label_cache_max_items個を超えたら最後に使われたのが古いものから削除する
+    # 図ごとにrcParamsが違っても別のラベルになるよう，ラベルの文字列を変えるrcParams（label_rc_keys）もキーに含める
+    label_cache: ClassVar[OrderedDict[tuple, list[str]]] = OrderedDict()
+    label_cache_max_items: ClassVar[int] = 4096
+    label_cache_lock: ClassVar[threading.Lock] = threading.Lock()
+    label_rc_keys: ClassVar[tuple[str, ...]] = (
+        "axes.unicode_minus",
+        "axes.formatter.use_mathtext",
+        "axes.formatter.use_locale",
+        "axes.formatter.limits",
+        "axes.formatter.min_exponent",
+        "axes.formatter.useoffset",
+        "axes.formatter.offset_threshold",
+        "text.usetex",
+    )
+
+    def __init__(self, formatter: ticker.Formatter, cache_key: tuple) -> None:
+        self.formatter = formatter
+        self.cache_key = cache_key
+
+    def set_axis(self, axis) -> None:
+        super().set_axis(axis)
+        self.formatter.set_axis(axis)
+
+    def __call__(self, x: float, pos: int | None = None) -> str:
+        return self.formatter(x, pos)
+
+    def format_ticks(self, values: list[float]) -> list[str]:
+        vmin, vmax = self.axis.get_view_interval()
+        rc_key = tuple(repr(mpl.rcParams[key]) for key in CachedFormatter.label_rc_keys)
+        key = (self.cache_key, rc_key, vmin, vmax, tuple(values))
+        with CachedFormatter.label_cache_lock:
+            if key in CachedFormatter.label_cache:
+                CachedFormatter.label_cache.move_to_end(key)
+                return CachedFormatter.label_cache[key]
+
+        labels = self.formatter.format_ticks(values)
+        with CachedFormatter.label_cache_lock:
+            CachedFormatter.label_cache[key] = labels
+            while (
+                len(CachedFormatter.label_cache) > CachedFormatter.label_cache_max_items
+            ):
+                CachedFormatter.label_cache.popitem(last=False)
+
+        return labels
+
+    def format_data(self, value: float) -> str:
+        return self.formatter.format_data(value)
+
+    def format_data_short(self, value: float) -> str:
+        return self.formatter.format_data_short(value)
+
+    def get_offset(self) -> str:
+        return self.formatter.get_offset()
+
+
+def set_ax_xticks(
+    ax: Axes,
+    space_x_ticks: float,
+    anchor_x_ticks: float,
+    strformatter_x: str | None,
+    is_plot_mticks_x: bool,
+    num_x_mtick: int,
+    xticks_font_size: float,
+) -> None:
+    major_locator_key = ("MultipleLocator", space_x_ticks, anchor_x_ticks)
+    ax.xaxis.set_major_locator(
+        CachedLocator(
+            ticker.MultipleLocator(base=space_x_ticks, offset=anchor_x_ticks),
+            cache_key=major_locator_key,
+        )
+    )
+
+    if strformatter_x is not None:
+        ax.xaxis.set_major_formatter(
+            CachedFormatter(
+                ticker.FormatStrFormatter(strformatter_x),
+                cache_key=("FormatStrFormatter", strformatter_x),
+            )
+        )
+
+    if is_plot_mticks_x:
+        # 副目盛りは主目盛りの位置にも依存する
+        ax.xaxis.set_minor_locator(
+            CachedLocator(
+                ticker.AutoMinorLocator(n=num_x_mtick + 1),
+                cache_key=("AutoMinorLocator", num_x_mtick, major_locator_key),
+            )
+        )
+
+    ax.tick_params(axis="x", labelsize=xticks_font_size)
+
+    return
+
+
+def set_ax_yticks(
+    ax: Axes,
+    space_y_ticks: float,
+    anchor_y_ticks: float,
+    strformatter_y: str | None,
+    is_plot_mticks_y: bool,
+    num_y_mtick: int,
+    yticks_font_size: float,
+) -> None:
+    major_locator_key = ("MultipleLocator", space_y_ticks, anchor_y_ticks)
+    ax.yaxis.set_major_locator(
+        CachedLocator(
+            ticker.MultipleLocator(base=space_y_ticks, offset=anchor_y_ticks),
+            cache_key=major_locator_key,
+        )
+    )
+
+    if strformatter_y is not None:
+        ax.yaxis.set_major_formatter(
+            CachedFormatter(
+                ticker.FormatStrFormatter(strformatter_y),
+                cache_key=("FormatStrFormatter", strformatter_y),
+            )
+        )
+
+    if is_plot_mticks_y:
+        # 副目盛りは主目盛りの位置にも依存する
+        ax.yaxis.set_minor_locator(
+            CachedLocator(
+                ticker.AutoMinorLocator(n=num_y_mtick + 1),
+                cache_key=("AutoMinorLocator", num_y_mtick, major_locator_key),
+            )
+        )
+
+    ax.tick_params(axis="y", labelsize=yticks_font_size)
+
+    return
+
+
+def set_ax_xticks_log(
+    ax: Axes,
+    log_base_x: int,
+    log_num_xticks: int | None,
+    is_log_plot_mticks_x: bool,
+    xticks_font_size: float,
+) -> None:
+    ax.set_xscale("log")
+    ax.xaxis.set_major_locator(
+        CachedLocator(
+            ticker.LogLocator(base=log_base_x, numticks=log_num_xticks),
+            cache_key=("LogLocator", log_base_x, log_num_xticks),
+        )
+    )
+    ax.xaxis.set_major_formatter(
+        CachedFormatter(
+            ticker.LogFormatterMathtext(base=log_base_x),
+            cache_key=("LogFormatterMathtext", log_base_x),
+        )
+    )
+
+    # フォントサイズ
+    ax.tick_params(axis="x", labelsize=xticks_font_size)
+
+    # 副目盛り
+    if is_log_plot_mticks_x:
+        ax.xaxis.set_minor_locator(
+            CachedLocator(
+                ticker.LogLocator(base=log_base_x, subs="auto"),
+                cache_key=("LogLocator", log_base_x, "auto"),
+            )
+        )
+    else:
+        ax.xaxis.minorticks_off()
+
+    return
+
+
+def set_ax_yticks_log(
+    ax: Axes,
+    log_base_y: int,
+    log_num_yticks: int | None,
+    is_log_plot_mticks_y: bool,
+    yticks_font_size: float,
+) -> None:
+    ax.set_yscale("log")
+    ax.yaxis.set_major_locator(
+        CachedLocator(
+            ticker.LogLocator(base=log_base_y, numticks=log_num_yticks),
+            cache_key=("LogLocator", log_base_y, log_num_yticks),
+        )
+    )
+    ax.yaxis.set_major_formatter(
+        CachedFormatter(
+            ticker.LogFormatterMathtext(base=log_base_y),
+            cache_key=("LogFormatterMathtext", log_base_y),
+        )
+    )
+
+    # フォントサイズ
+    ax.tick_params(axis="y", labelsize=yticks_font_size)
+
+    # 副目盛り
+    if is_log_plot_mticks_y:
+        ax.yaxis.set_minor_locator(
+            CachedLocator(
+                ticker.LogLocator(base=log_base_y, subs="auto"),
+                cache_key=("LogLocator", log_base_y, "auto"),
+            )
+        )
+    else:
+        ax.yaxis.minorticks_off()
+
+    return
+
+
+def set_xlabel(
+    ax: Axes,
+    xlabel_text: str,
+    xlabel_pos: float,
+    ymin: float,
+    xlabel_offset: float,
+    xlabel_pad: float | None,
+    xlabel_font_size: float,
+) -> None:
+    if xlabel_pad is None:
+        ax.text(
+            s=xlabel_text,
+            x=xlabel_pos,
+            y=ymin + xlabel_offset,
+            horizontalalignment="center",
+            verticalalignment="top",
+            fontsize=xlabel_font_size,
+            gid="x_title_text",
+        )
+        return
+
+    # 目盛り（線と値）の下端が軸の下端から何pt下にあるかを求め，そこからxlabel_pad[pt]下に置く
+    # （軸の位置が後で変わっても，軸の下端からの距離[pt]は変わらない）
+    # 大きさの計算だけなので，レンダラーは1画素分のバッファのもので足りる（LayoutCanvasと同様）
+    renderer = RendererAgg(1, 1, ax.figure.dpi)
+    ticks_bbox = ax.xaxis.get_tightbbox(renderer)
+    ticks_depth = 0.0
+    if ticks_bbox is not None:
+        ticks_depth = max(ax.bbox.y0 - ticks_bbox.y0, 0.0) * 72 / ax.figure.dpi
+
+    ax.annotate(
+        text=xlabel_text,
+        xy=(xlabel_pos, 0.0),
+        xycoords=ax.get_xaxis_transform(),  # xはデータ座標，yは軸の割合
+        xytext=(0.0, -(ticks_depth + xlabel_pad)),
+        textcoords="offset points",
+        horizontalalignment="center",
+        verticalalignment="top",
+        fontsize=xlabel_font_size,
+        gid="x_title_text",
+    )
+    return
+
+
+def set_ylabel(
+    ax: Axes,
+    ylabel_text: str,
+    ylabel_pos: float,
+    xmin: float,
+    ylabel_offset: float,
+    ylabel_pad: float | None,
+    ylabel_font_size: float,
+    is_horizontal_ylabel: bool,
+) -> None:
+    if ylabel_pad is None:
+        tmp = ax.text(
+            s=ylabel_text,
+            y=ylabel_pos,
+            x=xmin + ylabel_offset,
+            verticalalignment="center",
+            horizontalalignment="right",
+            fontsize=ylabel_font_size,
+            gid="y_title_text",
+        )
+    else:
+        # 目盛り（線と値）の左端が軸の左端から何pt左にあるかを求め，そこからylabel_pad[pt]左に置く
+        renderer = RendererAgg(1, 1, ax.figure.dpi)
+        ticks_bbox = ax.yaxis.get_tightbbox(renderer)
+        ticks_width = 0.0
+        if ticks_bbox is not None:
+            ticks_width = max(ax.bbox.x0 - ticks_bbox.x0, 0.0) * 72 / ax.figure.dpi
+
+        tmp = ax.annotate(
+            text=ylabel_text,
+            xy=(0.0, ylabel_pos),
+            xycoords=ax.get_yaxis_transform(),  # xは軸の割合，yはデータ座標
+            xytext=(-(ticks_width + ylabel_pad), 0.0),
+            textcoords="offset points",
+            verticalalignment="center",
+            horizontalalignment="right",
+            fontsize=ylabel_font_size,
+            gid="y_title_text",
+        )
+
+    if not is_horizontal_ylabel:
+        tmp.set_rotation("vertical")
+
+    return
+
+
+def set_gridline(ax: Axes, gridline_style: str) -> None:
+    ax.grid(linestyle=gridline_style)
+    ax.set_axisbelow(True)
+
+    return
+
+
+def iter_plotdata_chunks(
+    plotdata_path: Path, usecols: tuple[int, ...], chunk_rows: int, **loadtxt_kwargs
+):
+    # 素データ（テキスト）をchunk_rows行ずつ読み込み，usecolsの列を（行数 × 列数）の配列として順に返す
+    skiprows = loadtxt_kwargs.pop("skiprows", 0)
+    max_rows = loadtxt_kwargs.pop("max_rows", None)
+    encoding = loadtxt_kwargs.get("encoding")
+
+    num_rows = 0
+    with open(plotdata_path, encoding=encoding) as f:
+        lines = itertools.islice(f, skiprows, None)
+        while max_rows is None or num_rows < max_rows:
+            chunk_lines = list(itertools.islice(lines, chunk_rows))
+            if not chunk_lines:
+                break
+
+            with warnings.catch_warnings():
+                # コメント行のみのchunkで出る警告は無視
+                warnings.simplefilter("ignore", UserWarning)
+                chunk = np.loadtxt(
+                    chunk_lines,
+                    usecols=usecols,
+                    ndmin=2,
+                    max_rows=None if max_rows is None else max_rows - num_rows,
+                    **loadtxt_kwargs,
+                )
+            if len(chunk) == 0:
+                continue
+
+            num_rows += len(chunk)
+            yield chunk
+
+    return
+
+
+def decimate_minmax(
+    x: np.ndarray, y: np.ndarray, group_size: int
+) -> tuple[np.ndarray, np.ndarray]:
+    # 点列をgroup_size点ずつ区切り，各区間のyが最小・最大の2点（元の順序のまま）だけを残す
+    num_groups = -(-len(x) // group_size)
+    # 端数の区間は末尾の値で埋めて区間数を揃える
+    pad = num_groups * group_size - len(x)
+    xs = np.pad(x, (0, pad), mode="edge").reshape(num_groups, group_size)
+    ys = np.pad(y, (0, pad), mode="edge").reshape(num_groups, group_size)
+    idx_min = np.argmin(ys, axis=1)
+    idx_max = np.argmax(ys, axis=1)
+    idx = np.sort(np.stack([idx_min, idx_max], axis=1), axis=1)
+
+    return (
+        np.take_along_axis(xs, idx, axis=1).ravel(),
+        np.take_along_axis(ys, idx, axis=1).ravel(),
+    )
+
+
+def build_minmax_pyramid(
+    plotdata_path: Path,
+    pyramid_dir_path: Path,
+    usecols: tuple[int, int],
+    pyramid_factor: int,
+    chunk_rows: int,
+    **loadtxt_kwargs,
+) -> dict:
+    # 素データ（テキスト）をchunk_rows行ずつ読み込み，x,yをバイナリ（level0）として書き出す
+    pyramid_dir_path.mkdir(exist_ok=True)
+
+    num_points = 0
+    is_x_sorted = True
+    last_x = -np.inf
+    with (
+        open(pyramid_dir_path / "level0_x.f8", "wb") as fx,
+        open(pyramid_dir_path / "level0_y.f8", "wb") as fy,
+    ):
+        for chunk in iter_plotdata_chunks(
+            plotdata_path=plotdata_path,
+            usecols=usecols,
+            chunk_rows=chunk_rows,
+            **loadtxt_kwargs,
+        ):
+            x = np.ascontiguousarray(chunk[:, 0], dtype=np.float64)
+            y = np.ascontiguousarray(chunk[:, 1], dtype=np.float64)
+            if is_x_sorted and (x[0] < last_x or np.any(np.diff(x) < 0)):
+                is_x_sorted = False
+            last_x = x[-1]
+
+            x.tofile(fx)
+            y.tofile(fy)
+            num_points += len(chunk)
+
+    # level k の点列を (2 * pyramid_factor) 点ずつ区切り，各区間の最小・最大の2点（元の順序のまま）を level k+1 とする
+    # 各levelの点列はxについて昇順のままなので，読み込み時に二分探索できる
+    level_sizes = [num_points]
+    group_size = 2 * pyramid_factor
+    chunk_groups = max(chunk_rows // group_size, 1)
+    while is_x_sorted and level_sizes[-1] > 2 * group_size:
+        level = len(level_sizes) - 1
+        src_x = np.memmap(
+            pyramid_dir_path / f"level{level}_x.f8", dtype=np.float64, mode="r"
+        )
+        src_y = np.memmap(
+            pyramid_dir_path / f"level{level}_y.f8", dtype=np.float64, mode="r"
+        )
+        num_level_points = 0
+        with (
+            open(pyramid_dir_path / f"level{level + 1}_x.f8", "wb") as fx,
+            open(pyramid_dir_path / f"level{level + 1}_y.f8", "wb") as fy,
+        ):
+            for start in range(0, len(src_x), chunk_groups * group_size):
+                stop = min(start + chunk_groups * group_size, len(src_x))
+                x, y = decimate_minmax(
+                    x=src_x[start:stop], y=src_y[start:stop], group_size=group_size
+                )
+                x.tofile(fx)
+                y.tofile(fy)
+                num_level_points += len(x)
+        level_sizes.append(num_level_points)
+
+    return {"is_x_sorted": is_x_sorted, "level_sizes": level_sizes}
+
+
+minmax_pyramid_lock = threading.Lock()
+
+
+def read_plotdata(
+    plotdata_path: Path,
+    usecols: tuple[int, int],
+    is_use_minmax_pyramid: bool,
+    xmin: float,
+    xmax: float,
+    num_pixel_x: int,
+    pyramid_factor: int = 8,
+    chunk_rows: int = 1_000_000,
+    **loadtxt_kwargs,
+) -> np.ndarray:
+    if not is_use_minmax_pyramid:
+        skiprows = loadtxt_kwargs.get("skiprows", 0)
+        if (
+            skiprows >= row_index_block_rows
+            and plotdata_path.stat().st_size >= row_index_min_file_byte
+        ):
+            # 大きいファイルの途中からの行を読む場合は，行の索引で読む範囲を含む区間の先頭に移動してから読む（max_rowsの行数で止まる）
+            # （先頭付近の行だけなら，索引を作らなくてもnp.loadtxtがmax_rowsの行数で読み込みを止める）
+            row_index = get_row_index(
+                plotdata_path=plotdata_path, x_col=usecols[0], **loadtxt_kwargs
+            )
+            block_start = min(
+                skiprows // row_index_block_rows, len(row_index["offsets"]) - 1
+            )
+            # 索引の位置はバイト単位なので，バイナリで開いて移動してから文字列として読む（改行が\r\nのファイルでもずれない）
+            with open(plotdata_path, "rb") as f:
+                f.seek(row_index["offsets"][block_start])
+                return np.loadtxt(
+                    io.TextIOWrapper(
+                        f, encoding=loadtxt_kwargs.get("encoding") or "utf-8"
+                    ),
+                    usecols=usecols,
+                    **{
+                        **loadtxt_kwargs,
+                        "skiprows": skiprows - block_start * row_index_block_rows,
+                    },
+                )
+
+        return np.loadtxt(plotdata_path, usecols=usecols, **loadtxt_kwargs)
+
+    # ピラミッドは素データと同じフォルダに "<ファイル名>.pyramid" として保存
+    # 素データや読み込み設定ごとに "<ファイル名>.pyramid/<キーのハッシュ>" のフォルダを作り，作成後は書き換えない
+    pyramid_root_path = plotdata_path.with_name(f"{plotdata_path.name}.pyramid")
+    stat = plotdata_path.stat()
+    pyramid_key = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "usecols": list(usecols),
+        "pyramid_factor": pyramid_factor,
+        "loadtxt_kwargs": {
+            key: repr(val) for key, val in sorted(loadtxt_kwargs.items())
+        },
+    }
+    pyramid_dir_path = (
+        pyramid_root_path
+        / hashlib.sha256(json.dumps(pyramid_key).encode()).hexdigest()[:16]
+    )
+    meta_path = pyramid_dir_path / "meta.json"
+    # 同じプロセス内の複数のスレッドが同じピラミッドを同時に作らないようにする
+    with minmax_pyramid_lock:
+        if not meta_path.exists():
+            # 別のプロセス（並列実行やバッチ処理のワーカー）が読みかけのファイルを上書きしないよう，一時フォルダに作ってから名前を変える
+            # 同時に作った別のプロセスが先に名前を変えていた場合は，自分の一時フォルダを消してそちらを使う
+            pyramid_root_path.mkdir(exist_ok=True)
+            tmp_dir_path = Path(tempfile.mkdtemp(prefix=".tmp_", dir=pyramid_root_path))
+            try:
+                meta = build_minmax_pyramid(
+                    plotdata_path=plotdata_path,
+                    pyramid_dir_path=tmp_dir_path,
+                    usecols=usecols,
+                    pyramid_factor=pyramid_factor,
+                    chunk_rows=chunk_rows,
+                    **loadtxt_kwargs,
+                )
+                meta["key"] = pyramid_key
+                (tmp_dir_path / "meta.json").write_text(json.dumps(meta, indent=2))
+                # 名前を変える先のフォルダが既にあれば失敗する（POSIX・Windowsとも）
+                with contextlib.suppress(OSError):
+                    os.rename(tmp_dir_path, pyramid_dir_path)
+            finally:
+                shutil.rmtree(tmp_dir_path, ignore_errors=True)
+            # 素データが変わる前の古いピラミッドを消す（読み込み設定だけが違うものは残す，消せなければそのまま）
+            for old_dir_path in pyramid_root_path.iterdir():
+                if (
+                    old_dir_path.name.startswith(".tmp_")
+                    or old_dir_path == pyramid_dir_path
+                ):
+                    continue
+                if not old_dir_path.is_dir():
+                    # 以前の形式（フォルダ直下にlevelごとのファイル）のピラミッド
+                    with contextlib.suppress(OSError):
+                        old_dir_path.unlink()
+                    continue
+                with contextlib.suppress(Exception):
+                    old_key = json.loads((old_dir_path / "meta.json").read_text())[
+                        "key"
+                    ]
+                    if (old_key["size"], old_key["mtime_ns"]) != (
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                    ):
+                        shutil.rmtree(old_dir_path, ignore_errors=True)
+        meta = json.loads(meta_path.read_text())
+
+    def read_level(level: int) -> tuple[np.ndarray, np.ndarray]:
+        return (
+            np.memmap(
+                pyramid_dir_path / f"level{level}_x.f8", dtype=np.float64, mode="r"
+            ),
+            np.memmap(
+                pyramid_dir_path / f"level{level}_y.f8", dtype=np.float64, mode="r"
+            ),
+        )
+
+    if not meta["is_x_sorted"]:
+        # xが昇順でないデータは間引けないので全点を返す
+        x, y = read_level(0)
+        return np.column_stack((x, y))
+
+    # 表示範囲内の点数が横方向の画素数の2倍以上ある中で，最も粗いlevelを使う
+    for level in reversed(range(len(meta["level_sizes"]))):
+        x, y = read_level(level)
+        # 線が途切れないように表示範囲の外側の1点ずつも含める
+        start = max(np.searchsorted(x, xmin, side="left") - 1, 0)
+        stop = min(np.searchsorted(x, xmax, side="right") + 1, len(x))
+        if stop - start >= 2 * num_pixel_x or level == 0:
+            return np.column_stack((x[start:stop], y[start:stop]))
+
+
+def interp_sorted(
+    x_new: np.ndarray,
+    x_ref: np.ndarray,
+    y_ref: np.ndarray,
+    method: str = "linear",
+    chunk_size: int = 1 << 20,
+    num_threads: int | None = None,
+) -> np.ndarray:
+    # 昇順のx_refでの値y_refを，x_newの各点へ補間する（method: "linear"は線形補間，"nearest"は最も近い点の値）
+    # x_refの範囲外は端の値にする（np.interpと同じ）
+    # x_newをchunk_size点ずつに分け，二分探索と補間をスレッドで並行して行う（NumPyの処理中はGILが外れる）
+    # 線形補間はnp.interp（二分探索と補間をC言語で1度に行う）を，最も近い点はsearchsortedで求めた区間の両端を比べて使う
+    if method not in ("linear", "nearest"):
+        raise ValueError(f"未対応の補間方法です: {method}")
+    x_new = np.asarray(x_new, dtype=np.float64)
+    x_ref = np.asarray(x_ref, dtype=np.float64)
+    y_ref = np.asarray(y_ref, dtype=np.float64)
+    y_new = np.empty_like(x_new)
+    if len(x_ref) == 1:
+        y_new.fill(y_ref[0])
+        return y_new
+
+    def interp_chunk(start: int) -> None:
+        x = x_new[start : start + chunk_size]
+        if method == "linear":
+            y_new[start : start + chunk_size] = np.interp(x, x_ref, y_ref)
+            return
+        # x_ref[idx - 1] <= x < x_ref[idx] となるidx（範囲外は端の区間に寄せる）
+        idx = np.searchsorted(x_ref, x, side="right")
+        np.clip(idx, 1, len(x_ref) - 1, out=idx)
+        y_new[start : start + chunk_size] = np.where(
+            x - x_ref[idx - 1] <= x_ref[idx] - x, y_ref[idx - 1], y_ref[idx]
+        )
+
+        return
+
+    start_list = range(0, len(x_new), chunk_size)
+    if len(start_list) <= 1:
+        for start in start_list:
+            interp_chunk(start)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(interp_chunk, start_list))
+
+    return y_new
+
+
+def estimate_x_offset(
+    x_moving: np.ndarray,
+    y_moving: np.ndarray,
+    x_fixed: np.ndarray,
+    y_fixed: np.ndarray,
+    max_abs_offset: float | None = None,
+    max_grid_points: int = 1 << 22,
+    num_threads: int | None = None,
+) -> float:
+    # movingのx座標に加えるとfixedと最もよく重なるずらし量を，相互相関の最大値から推定する（x_moving・x_fixedは昇順）
+    # 両方を同じ間隔の等間隔格子へ補間し（格子の点数がmax_grid_points以下になるよう間隔を広げる），FFTで全てのずらし量での相関を一度に求める
+    # 相関が最大になる格子点の前後3点に放物線を当てはめ，格子の間隔より細かく推定する
+    dx = max(
+        (x_moving[-1] - x_moving[0]) / max(len(x_moving) - 1, 1),
+        (x_fixed[-1] - x_fixed[0]) / max(len(x_fixed) - 1, 1),
+        ((x_moving[-1] - x_moving[0]) + (x_fixed[-1] - x_fixed[0])) / max_grid_points,
+    )
+    grid_moving = x_moving[0] + dx * np.arange(
+        int((x_moving[-1] - x_moving[0]) / dx) + 1
+    )
+    grid_fixed = x_fixed[0] + dx * np.arange(int((x_fixed[-1] - x_fixed[0]) / dx) + 1)
+    g = interp_sorted(
+        x_new=grid_moving, x_ref=x_moving, y_ref=y_moving, num_threads=num_threads
+    )
+    f = interp_sorted(
+        x_new=grid_fixed, x_ref=x_fixed, y_ref=y_fixed, num_threads=num_threads
+    )
+    g -= g.mean()
+    f -= f.mean()
+
+    # correlation[k] = Σ_j f[j + k] * g[j]（kが負の分は末尾に回り込む）
+    # ずらし量 = (fixedの格子の始点 - movingの格子の始点) + k * dx
+    num_fft = len(f) + len(g) - 1
+    num_fft_fast = 1 << (num_fft - 1).bit_length()
+    correlation = np.fft.irfft(
+        np.fft.rfft(f, num_fft_fast) * np.conj(np.fft.rfft(g, num_fft_fast)),
+        num_fft_fast,
+    )
+    lag = np.arange(num_fft_fast)
+    lag[lag > len(f) - 1] -= num_fft_fast
+    offset = (x_fixed[0] - x_moving[0]) + lag * dx
+    is_valid = (lag > -len(g)) & (lag < len(f))
+    if max_abs_offset is not None:
+        is_valid &= np.abs(offset) <= max_abs_offset
+    if not np.any(is_valid):
+        raise ValueError("指定した範囲内にずらし量の候補がありません")
+    peak = np.flatnonzero(is_valid)[np.argmax(correlation[is_valid])]
+
+    c_minus = correlation[(peak - 1) % num_fft_fast]
+    c_plus = correlation[(peak + 1) % num_fft_fast]
+    curvature = c_minus - 2.0 * correlation[peak] + c_plus
+    shift = 0.5 * (c_minus - c_plus) / curvature if curvature < 0 else 0.0
+
+    return float(offset[peak] + np.clip(shift, -0.5, 0.5) * dx)
+
+
+# load_plotdataのtransform_listに指定できる変換（colは読み込んだ後の列番号）
+# - {"op": "scale", "col": 列, "factor": 倍率}：列に倍率をかける（単位換算など）
+# - {"op": "offset", "col": 列, "value": 値}：列に値を加える（座標をずらすなど）
+# - {"op": "derivative", "col": 列, "x_col": 列}：列をx_col列についての微分にする
+# - {"op": "moving_average", "col": 列, "window": 点数}：列を中心移動平均にする（両端は窓を縮める）
+# - {"op": "resample", "x_col": 列, "start": 値, "stop": 値, "num": 点数}：x_col列を等間隔の格子にし，他の列を線形補間する（x_col列は昇順）
+plotdata_transform_op_set = {
+    "scale",
+    "offset",
+    "derivative",
+    "moving_average",
+    "resample",
+}
+
+
+def get_affine_prefix(transform_list: list[dict]) -> dict[int, tuple[float, float]]:
+    # 変換の先頭から続くscale・offsetを，列ごとに1つの1次変換（factor * 値 + offset）にまとめる
+    affine_dict = {}
+    for transform in transform_list:
+        if transform["op"] not in ("scale", "offset"):
+            break
+        factor, offset = affine_dict.get(transform["col"], (1.0, 0.0))
+        if transform["op"] == "scale":
+            affine_dict[transform["col"]] = (
+                factor * transform["factor"],
+                offset * transform["factor"],
+            )
+        else:
+            affine_dict[transform["col"]] = (factor, offset + transform["value"])
+
+    return affine_dict
+
+
+def apply_plotdata_transforms(
+    data: np.ndarray, transform_list: list[dict]
+) -> np.ndarray:
+    # dataに変換を上から順に適用する（dataは書き換えてよい配列．resample以外はその場で書き換える）
+    # 連続するscale・offsetは列ごとに1つの1次変換にまとめてから適用するので，変換の数によらず列を読み書きするのは最大2回
+    idx = 0
+    while idx < len(transform_list):
+        affine_dict = get_affine_prefix(transform_list[idx:])
+        if affine_dict:
+            for col, (factor, offset) in affine_dict.items():
+                if factor != 1.0:
+                    np.multiply(data[:, col], factor, out=data[:, col])
+                if offset != 0.0:
+                    np.add(data[:, col], offset, out=data[:, col])
+            while idx < len(transform_list) and transform_list[idx]["op"] in (
+                "scale",
+                "offset",
+            ):
+                idx += 1
+            continue
+
+        transform = transform_list[idx]
+        if transform["op"] == "derivative":
+            data[:, transform["col"]] = np.gradient(
+                data[:, transform["col"]], data[:, transform["x_col"]]
+            )
+        elif transform["op"] == "moving_average":
+            # 累積和の差で窓内の和を求める（窓の大きさによらず計算量は点数に比例）
+            y = data[:, transform["col"]]
+            half = transform["window"] // 2
+            cumsum = np.concatenate(([0.0], np.cumsum(y)))
+            point_idx = np.arange(len(y))
+            lo = np.maximum(point_idx - half, 0)
+            hi = np.minimum(point_idx - half + transform["window"], len(y))
+            y[:] = (cumsum[hi] - cumsum[lo]) / (hi - lo)
+        elif transform["op"] == "resample":
+            x_grid = np.linspace(
+                transform["start"], transform["stop"], transform["num"]
+            )
+            resampled = np.empty((len(x_grid), data.shape[1]))
+            for col in range(data.shape[1]):
+                if col == transform["x_col"]:
+                    resampled[:, col] = x_grid
+                else:
+                    resampled[:, col] = interp_sorted(
+                        x_new=x_grid,
+                        x_ref=data[:, transform["x_col"]],
+                        y_ref=data[:, col],
+                    )
+            data = resampled
+        idx += 1
+
+    return data
+
+
+# 変換後のデータ（ファイル・読み込み設定・変換の内容 -> データ）．古いものから捨てて合計の大きさを上限以下に保つ
+plotdata_cache: OrderedDict[str, np.ndarray] = OrderedDict()
+plotdata_cache_max_byte = 256 * 1024**2
+plotdata_cache_lock = threading.Lock()
+
+
+def load_plotdata(
+    plotdata_path: Path,
+    usecols: tuple[int, int],
+    is_use_minmax_pyramid: bool,
+    xmin: float,
+    xmax: float,
+    num_pixel_x: int,
+    transform_list: list[dict] | None = None,
+    pyramid_factor: int = 8,
+    chunk_rows: int = 1_000_000,
+    is_lazy: bool = False,
+    **loadtxt_kwargs,
+) -> "np.ndarray | LazyPlotdata":
+    # データを読み込み，transform_listの変換を適用して返す（変更できない配列として返す）
+    # 同じファイル・読み込み設定・変換での結果はメモリにキャッシュし，同じプロセスで再び描画するときは読み込み・変換を省く
+    # is_lazyがTrueならまだ読み込まず，描画時に表示範囲内の行だけを読み込むLazyPlotdataを返す
+    transform_list = transform_list or []
+    for transform in transform_list:
+        if transform["op"] not in plotdata_transform_op_set:
+            raise ValueError(f"未対応の変換です: {transform['op']}")
+    if is_lazy:
+        return LazyPlotdata(
+            plotdata_path=plotdata_path,
+            usecols=usecols,
+            transform_list=transform_list,
+            **loadtxt_kwargs,
+        )
+
+    stat = plotdata_path.stat()
+    cache_key = hashlib.sha256(
+        repr(
+            (
+                os.fspath(plotdata_path.resolve()),
+                stat.st_size,
+                stat.st_mtime_ns,
+                usecols,
+                sorted(loadtxt_kwargs.items()),
+                transform_list,
+                (is_use_minmax_pyramid, xmin, xmax, num_pixel_x, pyramid_factor)
+                if is_use_minmax_pyramid
+                else None,
+            )
+        ).encode()
+    ).hexdigest()
+    with plotdata_cache_lock:
+        if cache_key in plotdata_cache:
+            plotdata_cache.move_to_end(cache_key)
+            return plotdata_cache[cache_key]
+
+    if is_use_minmax_pyramid:
+        if any(
+            transform["op"] not in ("scale", "offset") for transform in transform_list
+        ):
+            # 間引いた（min/maxの）点に微分・移動平均・補間をしても正しくないので，全点を読み込む
+            print(
+                "min/maxピラミッドは，scale・offset以外の変換とは併用できないため使用しません"
+            )
+            is_use_minmax_pyramid = False
+        elif 0 in get_affine_prefix(transform_list):
+            # 表示範囲を，変換前のx座標の範囲に戻してから点を選ぶ
+            factor, offset = get_affine_prefix(transform_list)[0]
+            xmin, xmax = sorted(((xmin - offset) / factor, (xmax - offset) / factor))
+
+    data = read_plotdata(
+        plotdata_path=plotdata_path,
+        usecols=usecols,
+        is_use_minmax_pyramid=is_use_minmax_pyramid,
+        xmin=xmin,
+        xmax=xmax,
+        num_pixel_x=num_pixel_x,
+        pyramid_factor=pyramid_factor,
+        chunk_rows=chunk_rows,
+        **loadtxt_kwargs,
+    )
+    data = apply_plotdata_transforms(data=data, transform_list=transform_list)
+
+    # キャッシュした配列を描画側で書き換えないようにする
+    data.flags.writeable = False
+    with plotdata_cache_lock:
+        plotdata_cache[cache_key] = data
+        while (
+            sum(cached.nbytes for cached in plotdata_cache.values())
+            > plotdata_cache_max_byte
+            and len(plotdata_cache) > 1
+        ):
+            plotdata_cache.popitem(last=False)
+
+    return data
+
+
+# 行の索引（ファイル・x列・読み込み設定 -> 索引）
+row_index_cache: dict[str, dict] = {}
+row_index_lock = threading.Lock()
+# 索引の区間の行数と，索引を使うファイルの大きさの下限（これより小さいファイルは索引を作らずに全体を読み込む）
+row_index_block_rows = 4096
+row_index_min_file_byte = 64 * 1024**2
+
+
+def parse_row_index_blocks(
+    block_bytes: bytes, block_bounds: list[int], x_col: int, loadtxt_kwargs: dict
+) -> np.ndarray:
+    # block_bytes内の各区間（block_bounds[i]からblock_bounds[i + 1]までのバイト）のxを読み，
+    # 区間ごとの（xの最小値，xの最大値，データ行数，区間内でxが昇順か）を返す
+    # 数値として読めない行（見出しなど）は除く（索引がskiprowsによらず使えるように）
+    encoding = loadtxt_kwargs.pop("encoding", None) or "utf-8"
+    result = np.empty((len(block_bounds) - 1, 4))
+    for i in range(len(block_bounds) - 1):
+        text = block_bytes[block_bounds[i] : block_bounds[i + 1]].decode(encoding)
+        with warnings.catch_warnings():
+            # コメント行のみの区間で出る警告は無視
+            warnings.simplefilter("ignore", UserWarning)
+            try:
+                x = np.loadtxt(
+                    io.StringIO(text), usecols=(x_col,), ndmin=1, **loadtxt_kwargs
+                )
+            except ValueError:
+                # 読めない行がある区間だけ，1行ずつ読む
+                x_list = []
+                for line in text.splitlines():
+                    with contextlib.suppress(ValueError):
+                        x_list.extend(
+                            np.loadtxt(
+                                [line], usecols=(x_col,), ndmin=1, **loadtxt_kwargs
+                            )
+                        )
+                x = np.array(x_list)
+        if len(x) == 0:
+            result[i] = (np.inf, -np.inf, 0, 1)
+        else:
+            result[i] = (x.min(), x.max(), len(x), np.all(np.diff(x) >= 0))
+
+    return result
+
+
+def build_row_index(
+    plotdata_path: Path,
+    x_col: int,
+    block_rows: int,
+    num_workers: int,
+    chunk_byte: int = 1 << 24,
+    **loadtxt_kwargs,
+) -> dict:
+    # ファイルをバイナリで先頭から1度だけ読み，block_rows行ごとの区間について
+    # 行頭のバイト位置（offsets．末尾の要素はファイルの大きさ）と，xの最小値・最大値・データ行数・区間内でxが昇順かを求める
+    # 区間のxの読み込みは，num_workersが2以上なら別プロセスで並行して行う（同時に読み込み待ちにするのはnum_workersの2倍まで）
+    loadtxt_kwargs.pop("skiprows", None)
+    loadtxt_kwargs.pop("max_rows", None)
+    offset_list = [np.zeros(1, dtype=np.int64)]
+    result_list = []
+    pending = deque()
+    num_line_starts = 1  # これまでに見つけた行頭の数（先頭行を含む）
+    num_byte = 0
+    carry = b""  # 最後の区間の区切りより後ろの，まだ区間にしていないバイト
+    with (
+        open(plotdata_path, "rb") as f,
+        ProcessPoolExecutor(max_workers=num_workers)
+        if num_workers > 1
+        else contextlib.nullcontext() as executor,
+    ):
+
+        def submit(block_bytes: bytes, block_bounds: list[int]) -> None:
+            args = (block_bytes, block_bounds, x_col, dict(loadtxt_kwargs))
+            if executor is None:
+                result_list.append(parse_row_index_blocks(*args))
+            else:
+                pending.append(executor.submit(parse_row_index_blocks, *args))
+                while len(pending) > 2 * num_workers:
+                    result_list.append(pending.popleft().result())
+
+            return
+
+        while chunk := f.read(chunk_byte):
+            # 改行の直後が次の行の行頭（line_start[i]は num_line_starts + i 行目の行頭）
+            line_start = (
+                np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+                + 1
+                + num_byte
+            )
+            block_start = line_start[(-num_line_starts) % block_rows :: block_rows]
+            if len(block_start):
+                # carryの先頭（直前の区間の区切り）から，このchunk内の最後の区間の区切りまでを区間に分ける
+                carry_start = offset_list[-1][-1]
+                block_bytes = carry + chunk[: block_start[-1] - num_byte]
+                submit(
+                    block_bytes=block_bytes,
+                    block_bounds=[0, *(block_start - carry_start).tolist()],
+                )
+                carry = chunk[block_start[-1] - num_byte :]
+                offset_list.append(block_start)
+            else:
+                carry += chunk
+            num_line_starts += len(line_start)
+            num_byte += len(chunk)
+        if carry:
+            submit(block_bytes=carry, block_bounds=[0, len(carry)])
+            offset_list.append(np.array([num_byte]))
+        while pending:
+            result_list.append(pending.popleft().result())
+
+    offsets = np.concatenate(offset_list)
+    result = (
+        np.concatenate(result_list) if result_list else np.empty((0, 4), dtype=float)
+    )
+    x_min, x_max, num_rows, is_block_sorted = result.T
+    has_data = num_rows > 0
+
+    return {
+        "offsets": offsets,
+        "x_min": x_min,
+        "x_max": x_max,
+        "num_rows": num_rows.astype(np.int64),
+        # データ行のある区間がどれも区間内で昇順で，前の区間の最大値 <= 次の区間の最小値なら，全体でxが昇順
+        "is_x_sorted": bool(
+            np.all(is_block_sorted[has_data] == 1)
+            and np.all(np.diff(x_min[has_data]) >= 0)
+            and np.all(x_min[has_data][1:] >= x_max[has_data][:-1])
+        ),
+    }
+
+
+def get_row_index(
+    plotdata_path: Path,
+    x_col: int,
+    block_rows: int = row_index_block_rows,
+    num_workers: int | None = None,
+    **loadtxt_kwargs,
+) -> dict:
+    # 行の索引はファイル・x列・読み込み設定（skiprows・max_rowsを除く）ごとに1度だけ作り，メモリにキャッシュする
+    # 索引は（row_index_min_file_byte以上の大きいファイルにだけ作るので）素データと同じフォルダに "<ファイル名>.rowindex.npz" として保存し，次回以降の実行でも使う
+    # 素データや読み込み設定が変わった場合のみ作り直す
+    stat = plotdata_path.stat()
+    index_key = json.dumps(
+        {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "x_col": x_col,
+            "block_rows": block_rows,
+            "loadtxt_kwargs": {
+                key: repr(val)
+                for key, val in sorted(loadtxt_kwargs.items())
+                if key not in ("skiprows", "max_rows")
+            },
+        }
+    )
+    cache_key = f"{os.fspath(plotdata_path.resolve())}\n{index_key}"
+    index_path = plotdata_path.with_name(f"{plotdata_path.name}.rowindex.npz")
+    # 複数のスレッドが同じ索引を同時に作らないようにする
+    with row_index_lock:
+        if cache_key in row_index_cache:
+            return row_index_cache[cache_key]
+
+        row_index = None
+        if index_path.exists():
+            with np.load(index_path) as npz:
+                if str(npz["key"]) == index_key:
+                    row_index = {name: npz[name] for name in npz.files if name != "key"}
+                    row_index["is_x_sorted"] = bool(row_index["is_x_sorted"])
+        if row_index is None:
+            row_index = build_row_index(
+                plotdata_path=plotdata_path,
+                x_col=x_col,
+                block_rows=block_rows,
+                num_workers=num_workers or os.cpu_count() or 1,
+                **loadtxt_kwargs,
+            )
+            # 他のスレッド・プロセスが読みかけのファイルを上書きしないよう，一時ファイルに書いてから置き換える
+            with tempfile.NamedTemporaryFile(
+                dir=index_path.parent, suffix=".npz", delete=False
+            ) as f:
+                np.savez(f, key=np.array(index_key), **row_index)
+            os.replace(f.name, index_path)
+        row_index_cache[cache_key] = row_index
+
+        return row_index
+
+
+def read_row_blocks(
+    plotdata_path: Path,
+    row_index: dict,
+    block_start: int,
+    block_stop: int,
+    usecols: tuple[int, ...],
+    block_rows: int = row_index_block_rows,
+    **loadtxt_kwargs,
+) -> np.ndarray:
+    # block_start番目からblock_stop番目の手前までの区間の行だけを（行頭のバイト位置に移動して）読み込む（skiprowsより前の行は除く）
+    skiprows = loadtxt_kwargs.pop("skiprows", 0)
+    encoding = loadtxt_kwargs.pop("encoding", None) or "utf-8"
+    offsets = row_index["offsets"]
+    with open(plotdata_path, "rb") as f:
+        f.seek(offsets[block_start])
+        text = f.read(offsets[block_stop] - offsets[block_start]).decode(encoding)
+
+    with warnings.catch_warnings():
+        # コメント行のみの区間で出る警告は無視
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(
+            io.StringIO(text),
+            usecols=usecols,
+            ndmin=2,
+            skiprows=max(skiprows - block_start * block_rows, 0),
+            **loadtxt_kwargs,
+        )
+
+
+class LazyPlotdata:
+    # ファイル・読み込み設定・変換だけを持ち，描画時（表示範囲と横方向の画素数が決まった後）に必要な行だけを読み込むデータ
+    # 行の索引（block_rows行ごとの区間のxの最小値・最大値）から，表示範囲と重なる区間（とその前後の区間）だけを読む
+    # 読み込んだ点は，横方向の1画素あたり2点程度になるようmin/maxで間引く
+    def __init__(
+        self,
+        plotdata_path: Path,
+        usecols: tuple[int, int],
+        transform_list: list[dict],
+        block_rows: int = row_index_block_rows,
+        **loadtxt_kwargs,
+    ) -> None:
+        self.plotdata_path = plotdata_path
+        self.usecols = usecols
+        self.transform_list = transform_list
+        self.block_rows = block_rows
+        self.loadtxt_kwargs = loadtxt_kwargs
+        self.window_key = None
+        self.window_data = None
+
+    def read_window(self, xmin: float, xmax: float, num_pixel_x: int) -> np.ndarray:
+        # 表示範囲[xmin, xmax]内の点（線が途切れないよう外側の1点ずつを含む）を読み込み，変換・間引きして返す
+        # 直前と同じ表示範囲・画素数なら読み込み直さない（保存形式ごとに描画し直す場合など）
+        window_key = (xmin, xmax, num_pixel_x)
+        if window_key == self.window_key:
+            return self.window_data
+
+        if (
+            any(
+                transform["op"] not in ("scale", "offset")
+                for transform in self.transform_list
+            )
+            or self.loadtxt_kwargs.get("max_rows") is not None
+            or self.plotdata_path.stat().st_size < row_index_min_file_byte
+        ):
+            # 微分・移動平均・補間は表示範囲外の点にも依存し，max_rowsは先頭からの行数なので，全点を読み込む
+            # 小さいファイルも，索引を作るより全体を読み込む方が速いので，全点を読み込む（読み込んだデータはキャッシュされる）
+            data = load_plotdata(
+                plotdata_path=self.plotdata_path,
+                usecols=self.usecols,
+                is_use_minmax_pyramid=False,
+                xmin=xmin,
+                xmax=xmax,
+                num_pixel_x=num_pixel_x,
+                transform_list=self.transform_list,
+                **self.loadtxt_kwargs,
+            )
+            x = data[:, 0]
+            if len(x) > 1 and np.all(np.diff(x) >= 0):
+                # xが昇順なら，表示範囲（と線が途切れないよう外側の1点ずつ）だけを残す
+                start = max(np.searchsorted(x, xmin, side="left") - 1, 0)
+                stop = min(np.searchsorted(x, xmax, side="right") + 1, len(x))
+                data = data[start:stop]
+        else:
+            # 表示範囲を，変換前のx座標の範囲に戻してから行を選ぶ
+            factor, offset = get_affine_prefix(self.transform_list).get(0, (1.0, 0.0))
+            data = self.read_x_window(
+                *sorted(((xmin - offset) / factor, (xmax - offset) / factor))
+            )
+            data = apply_plotdata_transforms(
+                data=data, transform_list=self.transform_list
+            )
+        # xが単調なデータだけを間引く（横方向の1画素に入る点の中でのmin/maxになるので見た目は変わらない）
+        dx = np.diff(data[:, 0])
+        if len(data) > 4 * num_pixel_x and (np.all(dx >= 0) or np.all(dx <= 0)):
+            x, y = decimate_minmax(
+                x=data[:, 0], y=data[:, 1], group_size=len(data) // num_pixel_x
+            )
+            data = np.column_stack((x, y))
+
+        self.window_key = window_key
+        self.window_data = data
+
+        return data
+
+    def read_x_window(self, xmin: float, xmax: float) -> np.ndarray:
+        # 表示範囲[xmin, xmax]と重なる区間を，前後の1区間ずつを含めて読み込む（線が表示範囲の端で途切れないように）
+        # 離れた区間どうしは（その間を線で結ばないよう）NaNの行をはさんでつなげる
+        loadtxt_kwargs = dict(self.loadtxt_kwargs)
+        row_index = get_row_index(
+            plotdata_path=self.plotdata_path,
+            x_col=self.usecols[0],
+            block_rows=self.block_rows,
+            **loadtxt_kwargs,
+        )
+        has_data = row_index["num_rows"] > 0
+        block_list = np.flatnonzero(
+            has_data & (row_index["x_max"] >= xmin) & (row_index["x_min"] <= xmax)
+        )
+        if len(block_list) == 0 and row_index["is_x_sorted"] and np.any(has_data):
+            # 表示範囲が2つの区間の間にある場合は，その2つの区間を読む
+            data_block_list = np.flatnonzero(has_data)
+            pos = np.searchsorted(row_index["x_min"][data_block_list], xmin)
+            block_list = data_block_list[max(pos - 1, 0) : pos + 1]
+        if len(block_list) == 0:
+            return np.empty((0, 2))
+
+        # 前後の1区間ずつを含めた連続する区間ごとに読み込む
+        num_blocks = len(row_index["offsets"]) - 1
+        run_break = np.flatnonzero(np.diff(block_list) > 3) + 1
+        data_list = []
+        for run in np.split(block_list, run_break):
+            data = read_row_blocks(
+                plotdata_path=self.plotdata_path,
+                row_index=row_index,
+                block_start=max(run[0] - 1, 0),
+                block_stop=min(run[-1] + 2, num_blocks),
+                usecols=self.usecols,
+                block_rows=self.block_rows,
+                **loadtxt_kwargs,
+            )
+            if row_index["is_x_sorted"]:
+                # 線が途切れないように表示範囲の外側の1点ずつも含める
+                x = data[:, 0]
+                start = max(np.searchsorted(x, xmin, side="left") - 1, 0)
+                stop = min(np.searchsorted(x, xmax, side="right") + 1, len(x))
+                data = data[start:stop]
+            if data_list:
+                data_list.append(np.full((1, data.shape[1]), np.nan))
+            data_list.append(data)
+
+        return np.concatenate(data_list)
+
+
+class LazyPlotdataLine(Line2D):
+    # 描画のたびに軸の表示範囲と横方向の画素数を調べ，LazyPlotdataから必要な点だけを読み込んで描く線
+    def __init__(self, plotdata: LazyPlotdata, **line_kwargs) -> None:
+        super().__init__([], [], **line_kwargs)
+        self.plotdata = plotdata
+
+    def draw(self, renderer) -> None:
+        xmin, xmax = sorted(self.axes.get_xlim())
+        data = self.plotdata.read_window(
+            xmin=xmin,
+            xmax=xmax,
+            num_pixel_x=max(int(np.ceil(self.axes.bbox.width)), 1),
+        )
+        self.set_data(data[:, 0], data[:, 1])
+        super().draw(renderer)
+
+
+def plot_plotdata(ax: Axes, data: "np.ndarray | LazyPlotdata", **line_kwargs) -> Line2D:
+    # load_plotdataの結果を線としてプロットする（LazyPlotdataは描画時に読み込む線として追加する）
+    if isinstance(data, LazyPlotdata):
+        line = LazyPlotdataLine(plotdata=data, **line_kwargs)
+        ax.add_line(line)
+        return line
+
+    (line,) = ax.plot(data[:, 0], data[:, 1], **line_kwargs)
+
+    return line
+
+
+def scatter_plotdata(ax: Axes, data: np.ndarray, **scatter_kwargs) -> PathCollection:
+    # load_plotdataの結果を点としてプロットする
+    return ax.scatter(data[:, 0], data[:, 1], **scatter_kwargs)
+
+
+def plot_series_table(
+    ax: Axes, data: list[np.ndarray], series_table: list[dict], gid: str
+) -> None:
+    # series_tableの各行（{"kind": "line"か"scatter", "style": 見た目}）のデータを，
+    # 見た目（ラベル以外）が同じ行ごとに1つのLineCollection・PathCollectionにまとめてプロットする
+    # Artistの数は系列の数ではなく見た目の種類の数になるので，系列が多い図（アンサンブル計算など）でも描画・保存が速い
+    # 凡例には，ラベルのある行ごとに同じ見た目の空の線・点を（表の順に）追加する
+    group_dict = {}
+    for series, series_data in zip(series_table, data):
+        kind = series.get("kind", "line")
+        style = {key: val for key, val in series["style"].items() if key != "label"}
+        group_key = (kind, repr(sorted(style.items())))
+        group_dict.setdefault(group_key, (kind, style, []))[2].append(series_data)
+
+    for group_idx, (kind, style, data_list) in enumerate(group_dict.values()):
+        if kind == "line":
+            # 線の端・角の形はLine2D（ax.plot）と同じにする
+            is_solid = style.get("linestyle", "-") in ("-", "solid")
+            ax.add_collection(
+                LineCollection(
+                    [series_data[:, :2] for series_data in data_list],
+                    capstyle=mpl.rcParams[
+                        "lines.solid_capstyle" if is_solid else "lines.dash_capstyle"
+                    ],
+                    joinstyle=mpl.rcParams[
+                        "lines.solid_joinstyle" if is_solid else "lines.dash_joinstyle"
+                    ],
+                    label="_nolegend_",
+                    gid=f"{gid}_{group_idx}",
+                    **style,
+                )
+            )
+        else:
+            ax.scatter(
+                np.concatenate([series_data[:, 0] for series_data in data_list]),
+                np.concatenate([series_data[:, 1] for series_data in data_list]),
+                label="_nolegend_",
+                gid=f"{gid}_{group_idx}",
+                **style,
+            )
+
+    for series in series_table:
+        if series["style"].get("label") is None:
+            continue
+        if series.get("kind", "line") == "line":
+            ax.add_line(Line2D([], [], **series["style"]))
+        else:
+            ax.scatter([], [], **series["style"])
+
+    return
+
+
+# データ読み込み用のプール（設定 -> プール）．同じ設定の図どうしで使いまわし，プロセスの終了時に閉じる
+plot_load_executor_dict: dict[tuple[int, bool], Executor] = {}
+plot_load_executor_lock = threading.Lock()
+
+
+def get_plot_load_executor(num_load_workers: int, is_load_in_process: bool) -> Executor:
+    # データ読み込み用のスレッドのプール（is_load_in_processがTrueならプロセスのプール）を返す
+    # ファイルの読み込み・np.loadtxtの解析はスレッドで並行でき，convertersなどPythonでの処理が多い読み込みはプロセスで並行する
+    # プロセスはspawnで作る（描画・変換用のスレッドが動いているプロセスをforkすると，子プロセスがロックを取れずに止まることがある）
+    # 子プロセスで実行するのはこのモジュールの関数だけなので，spawnで起動した子プロセスでも読み込める
+    key = (num_load_workers, is_load_in_process)
+    with plot_load_executor_lock:
+        if key not in plot_load_executor_dict:
+            plot_load_executor_dict[key] = (
+                ProcessPoolExecutor(
+                    max_workers=num_load_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                if is_load_in_process
+                else ThreadPoolExecutor(max_workers=num_load_workers)
+            )
+
+        return plot_load_executor_dict[key]
+
+
+def shutdown_plot_load_executors() -> None:
+    # データ読み込み用のプールを全て閉じる（プロセスの終了時に呼ばれる）
+    with plot_load_executor_lock:
+        for executor in plot_load_executor_dict.values():
+            executor.shutdown(cancel_futures=True)
+        plot_load_executor_dict.clear()
+
+    return
+
+
+atexit.register(shutdown_plot_load_executors)
+
+
+def submit_load_plotdata(executor: Executor, **load_kwargs) -> Future:
+    # load_plotdataをexecutorで実行し，結果のFutureを返す（すぐに返るので，次のブロックの読み込みも並行して始められる）
+    return executor.submit(load_plotdata, **load_kwargs)
+
+
+def add_pending_plot(
+    pending_plot_list: list[tuple],
+    plot_func,
+    data: Future | list[Future],
+    **plot_kwargs,
+) -> None:
+    # 読み込み中のデータのプロット（plot_func(data=読み込んだデータ, **plot_kwargs)）を予約する
+    # dataがFutureのリストなら，plot_funcには読み込んだデータのリストを渡す
+    pending_plot_list.append((plot_func, data, plot_kwargs))
+
+    return
+
+
+def commit_plots(pending_plot_list: list[tuple]) -> None:
+    # 予約したプロットを，予約した順にそれぞれの読み込みを待って図に追加する
+    # 全ブロックの読み込みは予約時に始まっているので，待つ時間は読み込み時間の合計ではなく最も遅いものの時間になる
+    # 重ね順は描画時にzorderで決まり，凡例の順は追加した順になるので，ブロックを順に読み込んでプロットした場合と同じ図になる
+    for plot_func, data, plot_kwargs in pending_plot_list:
+        plot_func(
+            data=[future.result() for future in data]
+            if isinstance(data, list)
+            else data.result(),
+            **plot_kwargs,
+        )
+        print(f"データプロット完了: {plot_kwargs.get('gid')}")
+    pending_plot_list.clear()
+
+    return
+
+
+error_norm_name_list = ["L1", "L2", "Linf"]
+
+
+def compute_error_norms(
+    numerical_path: Path,
+    reference_path: Path,
+    usecols_numerical: tuple[int, int] = (0, 1),
+    usecols_reference: tuple[int, int] = (0, 1),
+    loadtxt_kwargs_numerical: dict | None = None,
+    loadtxt_kwargs_reference: dict | None = None,
+    chunk_rows: int = 1_000_000,
+) -> dict[str, float]:
+    # 数値解の参照解（理論解など）に対する誤差 e = y_num - y_ref のL1・L2・Linfノルムを求める
+    # 参照解は全点を読み込み，数値解の各点のxへ線形補間する（xが同じ格子なら補間しても値は変わらない）
+    # 数値解はchunk_rows行ずつ読み込み，和と最大値だけを足し込むので，巨大なファイルでもメモリ使用量は一定
+    # ノルムは点数で割った離散ノルム：L1 = Σ|e| / N，L2 = sqrt(Σe² / N)，Linf = max|e|
+    # 参照解のxの範囲外にある数値解の点は（外挿になるので）除く
+    reference = np.loadtxt(
+        reference_path,
+        usecols=usecols_reference,
+        ndmin=2,
+        **(loadtxt_kwargs_reference or {}),
+    )
+    x_ref = reference[:, 0]
+    y_ref = reference[:, 1]
+    if np.any(np.diff(x_ref) < 0):
+        order = np.argsort(x_ref, kind="stable")
+        x_ref = x_ref[order]
+        y_ref = y_ref[order]
+
+    num_points = 0
+    sum_abs = 0.0
+    sum_sq = 0.0
+    max_abs = 0.0
+    for chunk in iter_plotdata_chunks(
+        plotdata_path=numerical_path,
+        usecols=usecols_numerical,
+        chunk_rows=chunk_rows,
+        **(loadtxt_kwargs_numerical or {}),
+    ):
+        x = chunk[:, 0]
+        is_inside = (x >= x_ref[0]) & (x <= x_ref[-1])
+        if not np.any(is_inside):
+            continue
+        error = np.abs(
+            chunk[is_inside, 1]
+            - interp_sorted(x_new=x[is_inside], x_ref=x_ref, y_ref=y_ref)
+        )
+        num_points += len(error)
+        sum_abs += float(np.sum(error))
+        sum_sq += float(np.dot(error, error))
+        max_abs = max(max_abs, float(np.max(error)))
+
+    if num_points == 0:
+        raise ValueError(
+            f"参照解のxの範囲内に数値解の点がありません: {numerical_path.name}"
+        )
+
+    return {
+        "L1": sum_abs / num_points,
+        "L2": float(np.sqrt(sum_sq / num_points)),
+        "Linf": max_abs,
+    }
+
+
+def fit_convergence_order(
+    resolution: np.ndarray, error: np.ndarray
+) -> tuple[float, float, np.ndarray]:
+    # 両対数で log(error) = slope * log(resolution) + intercept を最小二乗でフィットし，(slope, intercept, 隣り合う解像度間の傾き) を返す
+    # resolutionが格子幅・粒子間距離なら傾きがそのまま収束次数，格子数・粒子数なら傾きの符号を反転したものが収束次数
+    log_resolution = np.log(resolution)
+    log_error = np.log(error)
+    slope, intercept = np.polyfit(log_resolution, log_error, deg=1)
+    slope_pairwise = np.diff(log_error) / np.diff(log_resolution)
+
+    return float(slope), float(intercept), slope_pairwise
+
+
+def summarize_convergence_study(
+    error_norm_list: list[dict[str, float]],
+    numerical_path_list: list[Path],
+    resolution_list: list[float],
+    reference_path: Path,
+) -> dict[str, dict]:
+    # 解像度ごとの誤差ノルム（numerical_path_listと同じ順）から，ノルムごとに誤差の系列と収束次数のフィット結果を返す
+    # 各ノルムの結果は {"resolution", "error", "slope", "intercept", "slope_pairwise"} の辞書
+    resolution = np.asarray(resolution_list, dtype=np.float64)
+    order = np.argsort(resolution, kind="stable")
+
+    print(f"誤差ノルム（参照解: {reference_path.name}）")
+    for i in order:
+        print(
+            f"  {numerical_path_list[i].name} (解像度 {resolution[i]:g}): "
+            + ", ".join(
+                f"{name} = {error_norm_list[i][name]:.6e}"
+                for name in error_norm_name_list
+            )
+        )
+
+    convergence_result = {}
+    for name in error_norm_name_list:
+        error = np.array([error_norm_list[i][name] for i in order])
+        slope, intercept, slope_pairwise = fit_convergence_order(
+            resolution=resolution[order], error=error
+        )
+        convergence_result[name] = {
+            "resolution": resolution[order],
+            "error": error,
+            "slope": slope,
+            "intercept": intercept,
+            "slope_pairwise": slope_pairwise,
+        }
+        print(
+            f"  {name} の傾き: {slope:.3f}（隣り合う解像度間: "
+            + ", ".join(f"{s:.3f}" for s in slope_pairwise)
+            + "）"
+        )
+
+    return convergence_result
+
+
+def compute_convergence_study(
+    numerical_path_list: list[Path],
+    resolution_list: list[float],
+    reference_path: Path,
+    **compute_error_norms_kwargs,
+) -> dict[str, dict]:
+    # 解像度ごとの数値解について誤差ノルムを（このスレッドで順に）求め，ノルムごとに誤差の系列と収束次数のフィット結果を返す
+    return summarize_convergence_study(
+        error_norm_list=[
+            compute_error_norms(
+                numerical_path=numerical_path,
+                reference_path=reference_path,
+                **compute_error_norms_kwargs,
+            )
+            for numerical_path in numerical_path_list
+        ],
+        numerical_path_list=numerical_path_list,
+        resolution_list=resolution_list,
+        reference_path=reference_path,
+    )
+
+
+def submit_convergence_study(
+    executor: Executor,
+    numerical_path_list: list[Path],
+    reference_path: Path,
+    **compute_error_norms_kwargs,
+) -> list[Future]:
+    # 解像度ごとの数値解の誤差ノルム（compute_error_norms）をexecutorで実行し，結果のFutureのリスト（numerical_path_listと同じ順）を返す
+    return [
+        executor.submit(
+            compute_error_norms,
+            numerical_path=numerical_path,
+            reference_path=reference_path,
+            **compute_error_norms_kwargs,
+        )
+        for numerical_path in numerical_path_list
+    ]
+
+
+def plot_convergence(
+    ax: Axes,
+    convergence_result: dict,
+    label: str,
+    color: str,
+    linewidth: float,
+    marker: str,
+    zorder: float,
+    gid: str | None = None,
+    is_plot_fit_line: bool = True,
+) -> None:
+    # 誤差の系列をマーカー付きの線で，フィットした直線を同じ色の破線でプロットする
+    # 凡例のラベルには傾き（収束次数）を付ける
+    resolution = convergence_result["resolution"]
+    ax.plot(
+        resolution,
+        convergence_result["error"],
+        color=color,
+        linewidth=linewidth,
+        linestyle="-",
+        marker=marker,
+        label=rf"{label} $({convergence_result['slope']:.2f})$",
+        zorder=zorder,
+        gid=gid,
+    )
+    if is_plot_fit_line:
+        ax.plot(
+            resolution,
+            np.exp(convergence_result["intercept"])
+            * resolution ** convergence_result["slope"],
+            color=color,
+            linewidth=linewidth,
+            linestyle="--",
+            zorder=zorder,
+        )
+
+    return
+
+
+def plot_convergence_study(
+    ax: Axes,
+    data: list[dict[str, float]],
+    numerical_path_list: list[Path],
+    resolution_list: list[float],
+    reference_path: Path,
+    norm_style_list: list[tuple[str, str, str, str, float]],
+    linewidth: float,
+    gid: str | None = None,
+    is_plot_fit_line: bool = True,
+) -> None:
+    # 解像度ごとの誤差ノルム（submit_convergence_studyの結果）から収束次数をフィットし，ノルムごとにプロットする
+    # norm_style_listの各要素は (ノルムの名前（"L1", "L2", "Linf"）, 凡例のラベル, 色, マーカー, zorder)
+    convergence_result = summarize_convergence_study(
+        error_norm_list=data,
+        numerical_path_list=numerical_path_list,
+        resolution_list=resolution_list,
+        reference_path=reference_path,
+    )
+    for norm_name, label, color, marker, zorder in norm_style_list:
+        plot_convergence(
+            ax=ax,
+            convergence_result=convergence_result[norm_name],
+            label=label,
+            color=color,
+            linewidth=linewidth,
+            marker=marker,
+            zorder=zorder,
+            gid=None if gid is None else f"{gid}_{norm_name}",
+            is_plot_fit_line=is_plot_fit_line,
+        )
+
+    return
+
+
+def accumulate_ensemble_stats(
+    plotdata_path_list: list[Path],
+    x_grid: np.ndarray,
+    usecols: tuple[int, int],
+    transform_list: list[dict] | None = None,
+    **loadtxt_kwargs,
+) -> dict[str, np.ndarray]:
+    # 各ファイルのデータを共通の格子x_gridへ線形補間し，格子点ごとの標本数・平均・偏差平方和（Welford法）と最小・最大を1回の走査で求める
+    # ファイルは1つずつ読み込んで足し込んだら捨てる（キャッシュもしない）ので，メモリはファイルの数によらず格子と1ファイル分で済む
+    # 格子点がファイルのxの範囲外なら（外挿になるので）そのファイルは数えない
+    x_grid = np.asarray(x_grid, dtype=np.float64)
+    count = np.zeros(len(x_grid), dtype=np.int64)
+    mean = np.zeros(len(x_grid))
+    m2 = np.zeros(len(x_grid))
+    y_min = np.full(len(x_grid), np.inf)
+    y_max = np.full(len(x_grid), -np.inf)
+    for plotdata_path in plotdata_path_list:
+        data = read_plotdata(
+            plotdata_path=plotdata_path,
+            usecols=usecols,
+            is_use_minmax_pyramid=False,
+            xmin=x_grid[0],
+            xmax=x_grid[-1],
+            num_pixel_x=len(x_grid),
+            **loadtxt_kwargs,
+        )
+        data = apply_plotdata_transforms(data=data, transform_list=transform_list or [])
+        x = data[:, 0]
+        y = data[:, 1]
+        if np.any(np.diff(x) < 0):
+            order = np.argsort(x, kind="stable")
+            x = x[order]
+            y = y[order]
+        is_inside = (x_grid >= x[0]) & (x_grid <= x[-1])
+        y = interp_sorted(x_new=x_grid[is_inside], x_ref=x, y_ref=y)
+
+        count[is_inside] += 1
+        delta = y - mean[is_inside]
+        mean[is_inside] += delta / count[is_inside]
+        m2[is_inside] += delta * (y - mean[is_inside])
+        y_min[is_inside] = np.minimum(y_min[is_inside], y)
+        y_max[is_inside] = np.maximum(y_max[is_inside], y)
+
+    return {
+        "x": x_grid,
+        "num_files": len(plotdata_path_list),
+        "count": count,
+        "mean": mean,
+        "m2": m2,
+        "min": y_min,
+        "max": y_max,
+    }
+
+
+def merge_ensemble_stats(stats_list: list[dict]) -> dict[str, np.ndarray]:
+    # accumulate_ensemble_statsの結果（同じ格子で，別々のファイルについて求めたもの）を1つにまとめる
+    # 平均・偏差平方和は，2つの組の標本数・平均・偏差平方和から合わせた組の値を求める式（Chanらの方法）で順に合わせる
+    merged = dict(stats_list[0])
+    for stats in stats_list[1:]:
+        count = merged["count"] + stats["count"]
+        delta = stats["mean"] - merged["mean"]
+        weight = np.divide(
+            stats["count"], count, out=np.zeros(len(count)), where=count > 0
+        )
+        merged = {
+            "x": merged["x"],
+            "num_files": merged["num_files"] + stats["num_files"],
+            "count": count,
+            "mean": merged["mean"] + delta * weight,
+            "m2": merged["m2"] + stats["m2"] + delta**2 * merged["count"] * weight,
+            "min": np.minimum(merged["min"], stats["min"]),
+            "max": np.maximum(merged["max"], stats["max"]),
+        }
+
+    return merged
+
+
+def submit_ensemble_stats(
+    executor: Executor,
+    plotdata_path_list: list[Path],
+    num_jobs: int,
+    **accumulate_kwargs,
+) -> list[Future]:
+    # ファイルをnum_jobs組に分け，組ごとのaccumulate_ensemble_statsをexecutorで実行して，結果のFutureのリストを返す
+    # 組ごとの結果は格子の大きさなので，ファイルがいくつあっても受け渡す量は（格子点数 × 組の数）程度
+    return [
+        executor.submit(
+            accumulate_ensemble_stats,
+            plotdata_path_list=plotdata_path_list[job_idx::num_jobs],
+            **accumulate_kwargs,
+        )
+        for job_idx in range(min(num_jobs, len(plotdata_path_list)))
+    ]
+
+
+def plot_ensemble_band(
+    ax: Axes,
+    data: list[dict],
+    band_type: str,
+    num_std: float,
+    color: str,
+    linewidth: float,
+    linestyle: str,
+    band_alpha: float,
+    label: str,
+    band_label: str,
+    zorder: float,
+    gid: str | None = None,
+) -> None:
+    # 組ごとの統計（submit_ensemble_statsの結果）をまとめ，平均の線と帯（fill_between）をプロットする
+    # band_type: "std"は 平均 ± num_std × 標準偏差（不偏），"minmax"は全ファイルの最小から最大まで
+    # 標本が足りない格子点（平均は1つ未満，標準偏差は2つ未満）は描かない
+    if band_type not in ("std", "minmax"):
+        raise ValueError(f"未対応の帯の種類です: {band_type}")
+    stats = merge_ensemble_stats(stats_list=data)
+    count = stats["count"]
+    mean = np.where(count > 0, stats["mean"], np.nan)
+    if band_type == "std":
+        std = np.sqrt(
+            np.divide(
+                stats["m2"],
+                count - 1,
+                out=np.full(len(count), np.nan),
+                where=count > 1,
+            )
+        )
+        lower = mean - num_std * std
+        upper = mean + num_std * std
+    else:
+        lower = np.where(count > 0, stats["min"], np.nan)
+        upper = np.where(count > 0, stats["max"], np.nan)
+    print(
+        f"アンサンブル統計: {stats['num_files']} 個のファイル，格子 {len(count)} 点"
+        f"（格子点あたりの標本数 {count.min()}〜{count.max()}）"
+    )
+
+    ax.fill_between(
+        stats["x"],
+        lower,
+        upper,
+        where=np.isfinite(lower) & np.isfinite(upper),
+        color=color,
+        alpha=band_alpha,
+        linewidth=0.0,
+        label=band_label,
+        zorder=zorder,
+        gid=None if gid is None else f"{gid}_band",
+    )
+    ax.plot(
+        stats["x"],
+        mean,
+        color=color,
+        linewidth=linewidth,
+        linestyle=linestyle,
+        label=label,
+        zorder=zorder,
+        gid=gid,
+    )
+
+    return
+
+
+def get_file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024**2):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_output_ref(
+    output_store_dir_path: Path, output_path: Path
+) -> tuple[Path, dict]:
+    # 出力ファイルがどのblobを参照しているかの記録（refs内のファイルのパスと，その内容（なければ空））
+    ref_path = (
+        output_store_dir_path
+        / "refs"
+        / f"{hashlib.sha256(os.fsencode(os.path.abspath(output_path))).hexdigest()}.json"
+    )
+    ref = {}
+    with contextlib.suppress(FileNotFoundError, ValueError):
+        ref = json.loads(ref_path.read_text())
+
+    return ref_path, ref
+
+
+def is_output_same_as_blob(
+    output_path: Path, blob_path: Path, output_store_dir_path: Path, ref: dict
+) -> bool:
+    # 出力ファイルがblobと同じ内容か（リンクなら同じファイルか，コピーなら内容のハッシュで確かめる）
+    # 記録したblobが同じで，出力ファイルの大きさ・更新日時も記録したときから変わっていなければ，ハッシュは計算しない
+    if not (output_path.exists() and blob_path.exists()):
+        return False
+    if os.path.samefile(output_path, blob_path):
+        return True
+    stat = output_path.stat()
+    if ref.get("blob") == blob_path.relative_to(
+        output_store_dir_path
+    ).as_posix() and ref.get("stat") == [stat.st_size, stat.st_mtime_ns]:
+        return True
+
+    return (
+        stat.st_size == blob_path.stat().st_size
+        and get_file_digest(output_path) == blob_path.stem
+    )
+
+
+def link_output_to_blob(
+    output_path: Path, blob_path: Path, output_store_dir_path: Path
+) -> None:
+    # 出力ファイルをストア内のblobへのリンクにする（すでに同じ内容なら何も書き込まない）
+    # ハードリンクを優先し，作れない場合（別ドライブなど）はシンボリックリンク，それも無理ならコピーにする
+    # blobは読み込み専用なので，リンクの出力ファイルをその場で書き換えることはできない（ストアの内容は変わらない）
+    # （別のファイルとして保存し直すエディタなどではリンクが外れるだけで，そのblobは不要なblobの削除で消える）
+    # Windowsでは読み込み専用のファイルを置き換え・削除できないので，リンクにせず常にコピーにする
+    ref_path, ref = read_output_ref(
+        output_store_dir_path=output_store_dir_path, output_path=output_path
+    )
+    if not is_output_same_as_blob(
+        output_path=output_path,
+        blob_path=blob_path,
+        output_store_dir_path=output_store_dir_path,
+        ref=ref,
+    ):
+        tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+        tmp_path.unlink(missing_ok=True)
+        if os.name != "posix":
+            shutil.copyfile(blob_path, tmp_path)
+        else:
+            try:
+                os.link(blob_path, tmp_path)
+            except OSError:
+                try:
+                    os.symlink(os.path.relpath(blob_path, output_path.parent), tmp_path)
+                except OSError:
+                    shutil.copyfile(blob_path, tmp_path)
+        # 置き換えは一度に行われるので，途中で止まっても出力ファイルが壊れない
+        os.replace(tmp_path, output_path)
+
+    # どの出力ファイルがどのblobを参照しているかを記録しておく（不要なblobの削除に使う）
+    # コピーの場合も同じ内容か確かめられるよう，出力ファイルの大きさ・更新日時も記録する
+    stat = output_path.stat()
+    new_ref = {
+        "output": os.path.abspath(output_path),
+        "blob": blob_path.relative_to(output_store_dir_path).as_posix(),
+        "stat": [stat.st_size, stat.st_mtime_ns],
+    }
+    if ref != new_ref:
+        ref_path.parent.mkdir(parents=True, exist_ok=True)
+        # 不要なblobの削除（他のプロセス）が書きかけの記録を読まないよう，一時ファイルに書いてから置き換える
+        with tempfile.NamedTemporaryFile("w", dir=ref_path.parent, delete=False) as f:
+            f.write(json.dumps(new_ref))
+        os.replace(f.name, ref_path)
+
+    return
+
+
+def get_blob_path(output_store_dir_path: Path, digest: str, suffix: str) -> Path:
+    return output_store_dir_path / "blobs" / digest[:2] / f"{digest}{suffix}"
+
+
+# 一時フォルダの番号（同じ出力を複数のスレッドで同時に書き出しても，一時ファイルが重ならないようにする）
+tmp_output_counter = itertools.count()
+
+
+def get_tmp_output_path(output_path: Path) -> Path:
+    # 出力と同じフォルダ内の一時フォルダに，同じファイル名で書き出す
+    # （同じファイルシステム内なので置き換えが一度に行われ，ファイル名から決まる内容（epsのタイトルなど）も変わらない）
+    tmp_dir_path = output_path.parent / f".tmp_{os.getpid()}_{next(tmp_output_counter)}"
+    tmp_dir_path.mkdir(exist_ok=True)
+
+    return tmp_dir_path / output_path.name
+
+
+def add_pending_output(
+    tmp_path: Path,
+    output_path: Path,
+    output_store_dir_path: Path | None,
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+) -> None:
+    # 一時ファイルに書き出した出力を，commit_outputs()で最終的なパスに置くようpending_output_listに登録する
+    # （pending_output_listの要素は，一時ファイル，置き先のパス，（ストアを使う場合）置いたblobへのリンクにする出力ファイルのパス）
+    # ストアを使う場合は，同じ内容のblobがすでにあれば一時ファイルは捨ててリンクだけ置く
+    # （帯ごとに書き出したpngなど，メモリに載せずにファイルへ直接書き出したもの用）
+    if output_store_dir_path is None:
+        pending_output_list.append((tmp_path, output_path, None))
+        return
+
+    blob_path = get_blob_path(
+        output_store_dir_path=output_store_dir_path,
+        digest=get_file_digest(tmp_path),
+        suffix=output_path.suffix,
+    )
+    if blob_path.exists():
+        tmp_path.unlink()
+        tmp_path.parent.rmdir()
+        link_output_to_blob(
+            output_path=output_path,
+            blob_path=blob_path,
+            output_store_dir_path=output_store_dir_path,
+        )
+    else:
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        pending_output_list.append((tmp_path, blob_path, output_path))
+
+    return
+
+
+def write_output(
+    output_path: Path,
+    data: bytes,
+    output_store_dir_path: Path | None,
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+) -> None:
+    # 出力を一時ファイルに書き出す（最終的なパスにはcommit_outputs()でまとめて置く）
+    # output_store_dir_pathを指定した場合は，内容のハッシュをファイル名にしてストアに1つだけ保存し（blob），
+    # output_pathはそこへのリンクにする（同じ内容の出力は図や実行をまたいで共有され，変わっていなければ書き込まない）
+    link_blob_path = None
+    if output_store_dir_path is not None:
+        link_blob_path = get_blob_path(
+            output_store_dir_path=output_store_dir_path,
+            digest=hashlib.sha256(data).hexdigest(),
+            suffix=output_path.suffix,
+        )
+        if link_blob_path.exists():
+            link_output_to_blob(
+                output_path=output_path,
+                blob_path=link_blob_path,
+                output_store_dir_path=output_store_dir_path,
+            )
+            return
+        link_blob_path.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = get_tmp_output_path(output_path)
+    tmp_path.write_bytes(data)
+    if link_blob_path is None:
+        pending_output_list.append((tmp_path, output_path, None))
+    else:
+        pending_output_list.append((tmp_path, link_blob_path, output_path))
+
+    return
+
+
+def fsync_path(path: Path) -> None:
+    # ファイル・フォルダの内容をディスクに書き込む（フォルダのfsyncはPOSIXのみ）
+    # Windowsのfsyncは書き込み可能で開いたファイルにしか使えないので，書き込み可能で開く
+    # （POSIXでは読み込み専用で開けば，フォルダや読み込み専用のファイルにも使える）
+    if os.name == "posix":
+        flags = os.O_RDONLY
+    elif path.is_dir():
+        return
+    else:
+        flags = os.O_RDWR | os.O_BINARY
+
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    return
+
+
+# 途中で止まった以前の実行の一時フォルダを確認済みの出力フォルダ（プロセスごとに1回だけ確認する）
+stale_tmp_checked_dir_path_set: set[Path] = set()
+stale_tmp_checked_lock = threading.Lock()
+
+
+def remove_stale_tmp_dirs(
+    output_dir_path: Path, max_age_s: float = 24 * 60 * 60
+) -> None:
+    # 途中で止まった以前の実行の一時フォルダ（max_age_s秒以上前のもの）を削除する
+    # （同じフォルダに書き出している他のスレッド・プロセスが，確認の途中で自分の一時フォルダを消すこともある）
+    with stale_tmp_checked_lock:
+        if output_dir_path in stale_tmp_checked_dir_path_set:
+            return
+        stale_tmp_checked_dir_path_set.add(output_dir_path)
+
+    for stale_tmp_dir_path in output_dir_path.glob(".tmp_*"):
+        with contextlib.suppress(FileNotFoundError):
+            if time.time() - stale_tmp_dir_path.stat().st_mtime > max_age_s:
+                shutil.rmtree(stale_tmp_dir_path, ignore_errors=True)
+
+    return
+
+
+def commit_outputs(
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+    output_store_dir_path: Path | None,
+    is_fsync: bool,
+) -> list[Path]:
+    # 一時ファイルに書き出した出力（pending_output_list）をまとめて最終的なパスに置き，置いたパスの一覧を返す
+    # 置き換え（os.replace）は一度に行われるので，途中で止まっても書きかけのファイルが出力として残らない
+    # is_fsyncなら，置き換えの前に全ファイルをまとめてfsyncし，置き換えの後にフォルダを1回ずつfsyncする
+    # （ファイルを閉じるごとに書き込み完了を待たないので，ネットワークドライブなどでも遅くなりにくい）
+    time_start = time.perf_counter()
+    if is_fsync:
+        for tmp_path, _, _ in pending_output_list:
+            fsync_path(tmp_path)
+
+    committed_path_list = []
+    for tmp_path, final_path, link_output_path in pending_output_list:
+        if link_output_path is not None and os.name == "posix":
+            # ストアのblobは読み込み専用にしてから置く（リンクの出力ファイルを書き換えてストアの内容が変わらないように）
+            os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, final_path)
+        committed_path_list.append(final_path)
+        if link_output_path is not None:
+            link_output_to_blob(
+                output_path=link_output_path,
+                blob_path=final_path,
+                output_store_dir_path=output_store_dir_path,
+            )
+            committed_path_list.append(link_output_path)
+    for tmp_dir_path in {tmp_path.parent for tmp_path, _, _ in pending_output_list}:
+        tmp_dir_path.rmdir()
+        remove_stale_tmp_dirs(output_dir_path=tmp_dir_path.parent)
+    pending_output_list.clear()
+
+    if is_fsync:
+        for dir_path in {path.parent for path in committed_path_list}:
+            fsync_path(dir_path)
+    time_total = time.perf_counter() - time_start
+
+    print(
+        f"出力の確定: {len(committed_path_list)} 個，{time_total * 1e3:.1f} ms"
+        f"（fsync: {is_fsync}）"
+    )
+
+    return committed_path_list
+
+
+def gc_output_store(output_store_dir_path: Path, grace_s: float = 60.0) -> None:
+    # どの出力ファイルからも参照されていないblobを削除する
+    # （他のプロセスが書き込み中・リンク作成前のものを消さないよう，grace_s秒以内に作られたものは残す）
+    # 出力ファイルがリンクならblobと同じファイルか，コピーなら内容のハッシュが同じかで，参照されているか判断する
+    referenced_blob_path_set = set()
+    for ref_path in (output_store_dir_path / "refs").glob("*.json"):
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            ref = json.loads(ref_path.read_text())
+            blob_path = output_store_dir_path / ref["blob"]
+            if is_output_same_as_blob(
+                output_path=Path(ref["output"]),
+                blob_path=blob_path,
+                output_store_dir_path=output_store_dir_path,
+                ref=ref,
+            ):
+                referenced_blob_path_set.add(blob_path)
+            else:
+                ref_path.unlink(missing_ok=True)
+
+    num_removed = 0
+    size_removed = 0
+    for blob_path in (output_store_dir_path / "blobs").glob("*/*"):
+        stat = blob_path.stat()
+        if (
+            blob_path in referenced_blob_path_set
+            or time.time() - stat.st_mtime < grace_s
+        ):
+            continue
+        blob_path.unlink()
+        num_removed += 1
+        size_removed += stat.st_size
+
+    if num_removed:
+        print(
+            f"出力ストアの整理: 参照されていない {num_removed} 個"
+            f"（{size_removed / 1024:.1f} KB）を削除"
+        )
+
+    return
+
+
+# rcParams・環境変数を一時的に変えて保存する部分は，複数のスレッドで同時に行わない
+# （他のスレッドの保存にその変更が混ざらないようにする）
+savefig_rc_lock = threading.RLock()
+
+
+def savefig_to_bytes(
+    fig: Figure, extension: str, is_reproducible: bool, dpi: float | None = None
+) -> bytes:
+    # is_reproducibleなら，同じ図からは常に同じ内容が出力されるようにする
+    # （pdf・svg・epsの作成日時をSOURCE_DATE_EPOCHで固定し，svgのidに使う乱数も固定する）
+    # dpiがNoneならrcParams["savefig.dpi"]で保存する
+    buf = io.BytesIO()
+    if not is_reproducible:
+        fig.savefig(buf, format=extension, dpi=dpi)
+        return buf.getvalue()
+
+    with savefig_rc_lock:
+        source_date_epoch = os.environ.get("SOURCE_DATE_EPOCH")
+        os.environ["SOURCE_DATE_EPOCH"] = source_date_epoch or "0"
+        try:
+            with mpl.rc_context({"svg.hashsalt": "plot_store"}):
+                fig.savefig(buf, format=extension, dpi=dpi)
+        finally:
+            if source_date_epoch is None:
+                del os.environ["SOURCE_DATE_EPOCH"]
+
+    return buf.getvalue()
+
+
+def save_fig(
+    fig: Figure,
+    output_path: Path,
+    output_store_dir_path: Path | None,
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+    dpi: float | None = None,
+) -> None:
+    if output_store_dir_path is None:
+        tmp_path = get_tmp_output_path(output_path)
+        fig.savefig(tmp_path, dpi=dpi)
+        add_pending_output(
+            tmp_path=tmp_path,
+            output_path=output_path,
+            output_store_dir_path=None,
+            pending_output_list=pending_output_list,
+        )
+        return
+
+    write_output(
+        output_path=output_path,
+        data=savefig_to_bytes(
+            fig=fig, extension=output_path.suffix[1:], is_reproducible=True, dpi=dpi
+        ),
+        output_store_dir_path=output_store_dir_path,
+        pending_output_list=pending_output_list,
+    )
+
+    return
+
+
+def save_fig_svg_optimized(
+    fig: Figure,
+    output_path: Path,
+    svg_precision: int,
+    is_svg_gzip: bool,
+    output_store_dir_path: Path | None,
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+) -> None:
+    # svgを軽量化して保存する（XML宣言・DOCTYPE・gidの構造とsvg.fonttype="none"のテキストはそのまま残す）
+    # XMLとして読み込み直さず，savefigの出力の文字列を正規表現で書き換える
+    # - 座標の小数点以下をsvg_precision桁に丸める
+    # - 隣り合うpathのうち，塗りなし・不透明・実線で，見た目とclip-pathが同じものを1つのpathに結合する
+    #   （LineCollection（系列表など）は線ごとにpathを出力するので，同じgidのグループ内の線が1つのpathになる．
+    #   半透明の線は重なりの濃さが，破線は模様の区切りが変わるので結合しない）
+    # - 同じstyle属性をclass（<style>要素）にまとめる
+    # 通常の保存（savefig）と比べた容量と，軽量化にかかった時間を表示する
+    time_start = time.perf_counter()
+    svg_data = savefig_to_bytes(
+        fig=fig, extension="svg", is_reproducible=output_store_dir_path is not None
+    )
+    time_render = time.perf_counter() - time_start
+
+    svg_text = svg_data.decode("utf-8")
+    # 開始タグ（属性はタグ内だけを書き換え，テキストの内容は変えない）
+    tag_pattern = re.compile(r"<[A-Za-z][^<>]*>")
+
+    # 座標の丸め（ルートのsvg要素の大きさはそのまま）
+    # 属性ごとに，数値を全て"%.{svg_precision}f"の書式に置き換えた文字列を作って一度に書式化し，
+    # 末尾の0と"-0"の符号を正規表現で取り除く（数値ごとにPythonの関数を呼ばない）
+    float_pattern = re.compile(r"(-?\d+\.\d+)")
+    trailing_zero_pattern = re.compile(r"(\.\d*?)0+(?!\d)")
+    trailing_dot_pattern = re.compile(r"\.(?!\d)")
+    negative_zero_pattern = re.compile(r"(?<![\d.])-0(?![\d.])")
+    coord_attr_pattern = re.compile(
+        r'(\s(?:d|x|y|x1|y1|x2|y2|width|height|transform)=")([^"]*)"'
+    )
+
+    def round_coord_attr(match: re.Match) -> str:
+        # 数値以外の部分と数値が交互に並ぶ
+        part_list = float_pattern.split(" ".join(match.group(2).split()))
+        val = part_list[0]
+        if len(part_list) > 1:
+            val = f"%.{svg_precision}f".join(
+                part.replace("%", "%%") for part in part_list[::2]
+            ) % tuple(map(float, part_list[1::2]))
+            val = trailing_zero_pattern.sub(r"\1", val)
+            val = trailing_dot_pattern.sub("", val)
+            val = negative_zero_pattern.sub("0", val)
+        return f'{match.group(1)}{val}"'
+
+    def round_tag(match: re.Match) -> str:
+        if match.group().startswith("<svg"):
+            return match.group()
+        return coord_attr_pattern.sub(round_coord_attr, match.group())
+
+    svg_text = tag_pattern.sub(round_tag, svg_text)
+
+    # 線の結合（d以外の属性が同じpathが，空白だけをはさんで2つ以上続く部分）
+    path_run_pattern = re.compile(
+        r'<path d="([^"]*)"([^<>]*)/>((?:\s*<path d="[^"]*"\2/>)+)'
+    )
+
+    def merge_path_run(match: re.Match) -> str:
+        attrs = match.group(2)
+        if (
+            "fill: none" not in attrs
+            or "opacity" in attrs
+            or "stroke-dasharray" in attrs
+            or " id=" in attrs
+        ):
+            return match.group()
+        d_list = re.findall(r'<path d="([^"]*)"', match.group())
+        return f'<path d="{" ".join(d_list)}"{attrs}/>'
+
+    svg_text = path_run_pattern.sub(merge_path_run, svg_text)
+
+    # styleのclass化（class属性のある要素が無い場合のみ．Matplotlibはclass属性を出力しない）
+    style_classes: dict[str, str] = {}
+    style_attr_pattern = re.compile(r' style="([^"]*)"')
+
+    def style_to_class(match: re.Match) -> str:
+        class_name = style_classes.setdefault(match.group(1), f"s{len(style_classes)}")
+        return f' class="{class_name}"'
+
+    if ' class="' not in svg_text:
+        svg_text = tag_pattern.sub(
+            lambda match: style_attr_pattern.sub(style_to_class, match.group()),
+            svg_text,
+        )
+    if style_classes:
+        # ルートのsvg要素の直後に，classの定義を置く
+        # （style属性の値はエスケープ済みのまま要素の内容にしても，同じ文字列として読まれる）
+        root_tag_end = re.search(r"<svg\b[^>]*>", svg_text).end()
+        style_text = "".join(
+            f".{name}{{{style}}}" for style, name in style_classes.items()
+        )
+        svg_text = (
+            f"{svg_text[:root_tag_end]}\n <defs>\n"
+            f'  <style type="text/css">{style_text}</style>\n </defs>'
+            f"{svg_text[root_tag_end:]}"
+        )
+
+    data = svg_text.encode("utf-8")
+    if is_svg_gzip:
+        output_path = output_path.with_suffix(".svgz")
+        data = gzip.compress(data, compresslevel=9, mtime=0)
+    time_optimize = time.perf_counter() - time_start - time_render
+
+    write_output(
+        output_path=output_path,
+        data=data,
+        output_store_dir_path=output_store_dir_path,
+        pending_output_list=pending_output_list,
+    )
+    time_total = time.perf_counter() - time_start
+
+    print(
+        f"svg軽量化: 通常の保存 {len(svg_data) / 1024:.1f} KB -> {len(data) / 1024:.1f} KB"
+        f"（{len(data) / len(svg_data):.0%}），"
+        f"通常の保存の描画 {time_render * 1e3:.1f} ms に対して軽量化 +{time_optimize * 1e3:.1f} ms，"
+        f"書き出しまで合計 {time_total * 1e3:.1f} ms"
+    )
+
+    return
+
+
+def get_raster_pil_kwargs(
+    extension: str, jpeg_quality: int, png_compress_level: int, is_raster_optimize: bool
+) -> dict:
+    if extension in ("jpg", "jpeg"):
+        return {"quality": jpeg_quality, "optimize": is_raster_optimize}
+    if extension == "png":
+        return {"compress_level": png_compress_level, "optimize": is_raster_optimize}
+
+    return {}
+
+
+def print_raster_benchmark(rgba: memoryview, dpi: float) -> None:
+    # 同じ描画結果からの変換について，設定ごとの変換時間と容量の一覧を表示する
+    print("ラスター画像の変換時間と容量（描画1回分のバッファから変換）")
+    # 全角文字は表示幅が2文字分なので，その分だけ詰めて揃える
+    print(f"  {'形式':<4}{'設定':<32}{'時間 [ms]':>8}{'容量 [KB]':>8}")
+    settings_list = [
+        *(
+            ("jpeg", quality, 6, is_optimize)
+            for quality in (50, 75, 90, 95)
+            for is_optimize in (False, True)
+        ),
+        *(("png", 75, level, False) for level in (1, 3, 6, 9)),
+        ("png", 75, 9, True),
+    ]
+    for (
+        extension,
+        jpeg_quality,
+        png_compress_level,
+        is_raster_optimize,
+    ) in settings_list:
+        pil_kwargs = get_raster_pil_kwargs(
+            extension=extension,
+            jpeg_quality=jpeg_quality,
+            png_compress_level=png_compress_level,
+            is_raster_optimize=is_raster_optimize,
+        )
+        buf = io.BytesIO()
+        time_start = time.perf_counter()
+        mpl.image.imsave(
+            buf, rgba, format=extension, origin="upper", dpi=dpi, pil_kwargs=pil_kwargs
+        )
+        time_encode = time.perf_counter() - time_start
+        settings_text = ", ".join(f"{key}={val}" for key, val in pil_kwargs.items())
+        print(
+            f"  {extension:<6}{settings_text:<34}"
+            f"{time_encode * 1e3:>10.1f}{buf.getbuffer().nbytes / 1024:>10.1f}"
+        )
+
+    return
+
+
+def combine_adler32(adler1: int, adler2: int, len2: int) -> int:
+    # 連続する2つのデータのadler32から，つなげたデータのadler32を求める（zlibのadler32_combineと同じ計算）
+    base = 65521
+    sum1 = ((adler1 & 0xFFFF) + (adler2 & 0xFFFF) - 1) % base
+    sum2 = ((adler1 >> 16) + (adler2 >> 16) + len2 * ((adler1 & 0xFFFF) - 1)) % base
+
+    return sum1 | (sum2 << 16)
+
+
+def write_png_streamed(
+    rgba: memoryview,
+    dpi: float,
+    output_path: Path,
+    png_band_max_mb: float,
+    num_png_encode_workers: int,
+) -> None:
+    # 描画バッファを横長の帯に分け，帯ごとにpngへ圧縮しながら書き出す（PILを通さないpngの書き出し）
+    # PIL画像への変換や，画像全体のフィルター済みデータを作らないので，描画バッファ以外のメモリは帯数個分だけ
+    # （描画バッファ自体は図全体の大きさなので，メモリ使用量は画像の大きさに比例する）
+    # （図を帯ごとに描画すると，破線の模様やパスの間引きが帯の境目で途切れて継ぎ目ができるので，描画は1回で行う）
+    # 帯の圧縮はスレッドで並列に行い，つないで1つのzlibのデータにする（zlibの圧縮中はGILが外れる）
+    rgba = np.asarray(rgba)
+    height, width = rgba.shape[:2]
+    rows = rgba.reshape(height, width * 4)
+    band_height = max(int(png_band_max_mb * 1024**2 // (width * 4)), 1)
+    band_top_list = list(range(0, height, band_height))
+    # 前の帯の末尾（deflateの参照範囲の32KB）を辞書にし，帯ごとに圧縮しても圧縮率がほぼ変わらないようにする
+    dict_rows = -(-32768 // (1 + width * 4))
+
+    def filter_rows(start: int, stop: int) -> np.ndarray:
+        # 各行を1つ上の行との差分にする（行頭の2はpngの"Up"フィルターの指定）
+        filtered = np.empty((stop - start, 1 + width * 4), dtype=np.uint8)
+        filtered[:, 0] = 2
+        if start == 0:
+            filtered[0, 1:] = rows[0]
+        else:
+            np.subtract(rows[start], rows[start - 1], out=filtered[0, 1:])
+        np.subtract(
+            rows[start + 1 : stop], rows[start : stop - 1], out=filtered[1:, 1:]
+        )
+        return filtered
+
+    def compress_band(top: int) -> tuple[bytes, int, int]:
+        stop = min(top + band_height, height)
+        filtered = filter_rows(top, stop)
+        if top == 0:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            zdict = filter_rows(max(top - dict_rows, 0), top).tobytes()[-32768:]
+            compressor = zlib.compressobj(
+                6, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict
+            )
+        # 最後の帯以外はバイト境界で区切って（Z_SYNC_FLUSH）次の帯の圧縮データとつなげられるようにする
+        data = compressor.compress(filtered) + compressor.flush(
+            zlib.Z_FINISH if stop == height else zlib.Z_SYNC_FLUSH
+        )
+        return data, zlib.adler32(filtered), filtered.nbytes
+
+    def write_chunk(f, chunk_type: bytes, data: bytes) -> None:
+        f.write(struct.pack(">I", len(data)) + chunk_type + data)
+        f.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    with open(output_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        # 8bit RGBA
+        write_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        # 解像度（1mあたりの画素数）
+        pixels_per_meter = round(dpi / 0.0254)
+        write_chunk(
+            f, b"pHYs", struct.pack(">IIB", pixels_per_meter, pixels_per_meter, 1)
+        )
+
+        # zlibのヘッダー（deflate，32KBの参照範囲，圧縮レベル6）
+        write_chunk(f, b"IDAT", b"\x78\x9c")
+        adler = 1
+
+        def write_band(band: tuple[bytes, int, int]) -> None:
+            nonlocal adler
+            data, band_adler, band_len = band
+            adler = combine_adler32(adler1=adler, adler2=band_adler, len2=band_len)
+            write_chunk(f, b"IDAT", data)
+
+        if num_png_encode_workers <= 1:
+            for top in band_top_list:
+                write_band(compress_band(top))
+        else:
+            with ThreadPoolExecutor(max_workers=num_png_encode_workers) as executor:
+                # 先行して圧縮する帯の数を制限し，書き出し待ちの帯でメモリが増えないようにする
+                futures = deque()
+                for top in band_top_list:
+                    futures.append(executor.submit(compress_band, top))
+                    if len(futures) >= 2 * num_png_encode_workers:
+                        write_band(futures.popleft().result())
+                while futures:
+                    write_band(futures.popleft().result())
+
+        write_chunk(f, b"IDAT", struct.pack(">I", adler))
+        write_chunk(f, b"IEND", b"")
+
+    return
+
+
+def save_fig_raster(
+    fig: Figure,
+    output_path_list: list[Path],
+    jpeg_quality: int,
+    png_compress_level: int,
+    is_raster_optimize: bool,
+    is_print_raster_benchmark: bool,
+    is_png_streamed: bool,
+    png_band_max_mb: float,
+    num_png_encode_workers: int,
+    output_store_dir_path: Path | None,
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+) -> None:
+    # 描画は1回だけ行い，同じRGBAバッファから各形式（jpeg, pngなど）への変換をスレッドで並列に行う
+    # （変換はsavefigと同じmatplotlib.image.imsaveで行うので，出力はsavefigと同じになる）
+    canvas = (
+        fig.canvas if isinstance(fig.canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
+    )
+    canvas.draw()
+    rgba = canvas.buffer_rgba()
+
+    def encode(output_path: Path) -> None:
+        extension = output_path.suffix[1:]
+        if is_png_streamed and extension == "png":
+            # pngは描画バッファから帯ごとに圧縮しながら書き出す
+            tmp_path = get_tmp_output_path(output_path)
+            write_png_streamed(
+                rgba=rgba,
+                dpi=fig.dpi,
+                output_path=tmp_path,
+                png_band_max_mb=png_band_max_mb,
+                num_png_encode_workers=num_png_encode_workers,
+            )
+            add_pending_output(
+                tmp_path=tmp_path,
+                output_path=output_path,
+                output_store_dir_path=output_store_dir_path,
+                pending_output_list=pending_output_list,
+            )
+            return
+
+        buf = io.BytesIO()
+        mpl.image.imsave(
+            buf,
+            rgba,
+            format=extension,
+            origin="upper",
+            dpi=fig.dpi,
+            pil_kwargs=get_raster_pil_kwargs(
+                extension=extension,
+                jpeg_quality=jpeg_quality,
+                png_compress_level=png_compress_level,
+                is_raster_optimize=is_raster_optimize,
+            ),
+        )
+        write_output(
+            output_path=output_path,
+            data=buf.getvalue(),
+            output_store_dir_path=output_store_dir_path,
+            pending_output_list=pending_output_list,
+        )
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(encode, output_path_list))
+
+    if is_print_raster_benchmark:
+        print_raster_benchmark(rgba=rgba, dpi=fig.dpi)
+
+    return
+
+
+# フォントファイルの内容のハッシュ（パス・大きさ・更新日時 -> ハッシュ．同じプロセスでは1回だけ読む）
+font_file_digest_cache: dict[tuple, str] = {}
+# pdfに埋め込むグリフ（キー -> グリフ）．ディスクのキャッシュをプロセス内でも使いまわす
+# （pdf_charprocs_cache_max_items個を超えたら，最後に使われたのが古いものから削除する）
+pdf_charprocs_cache: OrderedDict[str, dict[str, bytes]] = OrderedDict()
+pdf_charprocs_cache_max_items = 256
+# ディスクのキャッシュとして残すファイル数の上限（古く使われていないものから削除する）
+pdf_font_cache_max_files = 1024
+
+
+def get_font_file_digest(font_path) -> str:
+    stat = os.stat(font_path)
+    key = (os.fspath(font_path), stat.st_size, stat.st_mtime_ns)
+    if key not in font_file_digest_cache:
+        digest = hashlib.sha256()
+        with open(font_path, "rb") as f:
+            while chunk := f.read(1024**2):
+                digest.update(chunk)
+        font_file_digest_cache[key] = digest.hexdigest()
+
+    return font_file_digest_cache[key]
+
+
+@contextlib.contextmanager
+def use_pdf_font_cache(cache_dir_path: Path):
+    # この中での保存の間だけ，pdfに埋め込むType 3フォントのグリフ（フォントファイルとグリフの組ごと）をディスクに保存し，
+    # 図やプロセスをまたいで使いまわす（backend_pdf._get_pdf_charprocsを差し替え，抜けると元に戻す）
+    # キーはmatplotlibのバージョン・フォントファイルの内容のハッシュ・グリフ
+    # 差し替えはプロセス全体に効くので，savefig_rc_lockを取った中で使う（他のスレッドのpdfの保存に混ざらないように）
+    get_pdf_charprocs_orig = getattr(backend_pdf, "_get_pdf_charprocs", None)
+    if get_pdf_charprocs_orig is None:
+        # matplotlibの更新で関数がなくなった場合は，キャッシュせずに保存する
+        yield
+        return
+
+    cache_dir_path.mkdir(parents=True, exist_ok=True)
+
+    def get_pdf_charprocs(font_path, glyph_indices):
+        glyph_indices = sorted(glyph_indices)
+        cache_key = hashlib.sha256(
+            repr(
+                (mpl.__version__, get_font_file_digest(font_path), glyph_indices)
+            ).encode()
+        ).hexdigest()
+
+        if cache_key in pdf_charprocs_cache:
+            pdf_charprocs_cache.move_to_end(cache_key)
+            return pdf_charprocs_cache[cache_key]
+
+        cache_path = cache_dir_path / f"{cache_key}.pickle"
+        try:
+            charprocs = pickle.loads(cache_path.read_bytes())
+            # 使ったキャッシュは新しいものとして残す
+            os.utime(cache_path)
+        except FileNotFoundError:
+            charprocs = get_pdf_charprocs_orig(font_path, glyph_indices)
+            # 他のプロセスが読みかけのファイルを上書きしないよう，一時ファイルに書いてから置き換える
+            with tempfile.NamedTemporaryFile(dir=cache_dir_path, delete=False) as f:
+                pickle.dump(charprocs, f)
+            os.replace(f.name, cache_path)
+            prune_cache_dir(
+                cache_dir_path=cache_dir_path,
+                pattern="*.pickle",
+                max_files=pdf_font_cache_max_files,
+            )
+
+        pdf_charprocs_cache[cache_key] = charprocs
+        while len(pdf_charprocs_cache) > pdf_charprocs_cache_max_items:
+            pdf_charprocs_cache.popitem(last=False)
+        return charprocs
+
+    backend_pdf._get_pdf_charprocs = get_pdf_charprocs
+    try:
+        yield
+    finally:
+        backend_pdf._get_pdf_charprocs = get_pdf_charprocs_orig
+
+
+def save_fig_pdf(
+    fig: Figure,
+    output_path: Path,
+    pdf_compression: int,
+    is_use_pdf_font_cache: bool,
+    output_store_dir_path: Path | None,
+    pending_output_list: list[tuple[Path, Path, Path | None]],
+) -> None:
+    time_start = time.perf_counter()
+    with (
+        savefig_rc_lock,
+        mpl.rc_context({"pdf.compression": pdf_compression}),
+        use_pdf_font_cache(cache_dir_path=Path(mpl.get_cachedir()) / "pdf_font_cache")
+        if is_use_pdf_font_cache
+        else contextlib.nullcontext(),
+    ):
+        data = savefig_to_bytes(
+            fig=fig,
+            extension="pdf",
+            is_reproducible=output_store_dir_path is not None,
+        )
+    write_output(
+        output_path=output_path,
+        data=data,
+        output_store_dir_path=output_store_dir_path,
+        pending_output_list=pending_output_list,
+    )
+    time_total = time.perf_counter() - time_start
+
+    print(
+        f"pdf保存: {len(data) / 1024:.1f} KB，{time_total * 1e3:.1f} ms"
+        f"（圧縮レベル {pdf_compression}）"
+    )
+
+    return
+
+
+# プレビュー後にバックグラウンドで全形式を保存するプロセスであることを示す環境変数
+preview_refine_env_name = "PLOT_PY_PREVIEW_REFINE"
+
+
+def start_background_refine(plot_py_path: Path, log_path: Path) -> None:
+    # 同じplot.pyをプレビューなしで別プロセスとして起動し，全形式の保存を任せる（終了は待たない）
+    # 標準出力・エラー出力はlog_pathに書き出す
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        subprocess.Popen(
+            [sys.executable, str(plot_py_path)],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            env={
+                **os.environ,
+                preview_refine_env_name: "1",
+                "PYTHONIOENCODING": "utf-8",
+            },
+            start_new_session=True,
+        )
+
+    return
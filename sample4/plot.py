@@ -1,256 +1,50 @@
+import os
 from pathlib import Path
 
 import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.style as mplstyle
-import matplotlib.ticker as ticker
-import numpy as np
-from matplotlib.axes import Axes
-from matplotlib.collections import PathCollection
-from matplotlib.figure import Figure
-from matplotlib.legend import Legend
-from matplotlib.lines import Line2D
-
-
-def set_mplparams_init(
-    is_use_TimesNewRoman_in_mathtext: bool,
-    axis_lw: float,
-    is_plot_mticks_x: bool,
-    is_plot_mticks_y: bool,
-) -> None:
-    # 描画高速化
-    mplstyle.use("fast")
-
-    # svg用の設定
-    mpl.use("Agg")
-    plt.rcParams["svg.fonttype"] = "none"
-
-    # MatplotlibのデフォルトフォントをTimes New Romanに設定
-    plt.rcParams["font.family"] = "Times New Roman"
-
-    # mathtext関連
-    if is_use_TimesNewRoman_in_mathtext:
-        plt.rcParams["mathtext.fontset"] = "custom"
-        plt.rcParams["mathtext.it"] = "Times New Roman:italic"
-        plt.rcParams["mathtext.bf"] = "Times New Roman:bold"
-        plt.rcParams["mathtext.bfit"] = "Times New Roman:italic:bold"
-        plt.rcParams["mathtext.rm"] = "Times New Roman"
-        plt.rcParams["mathtext.fallback"] = "cm"
-    else:
-        plt.rcParams["mathtext.fontset"] = "cm"
-
-    # x軸,y軸の目盛りの向き
-    plt.rcParams["xtick.direction"] = "out"
-    plt.rcParams["ytick.direction"] = "out"
-
-    # 軸関係
-    plt.rcParams["axes.linewidth"] = axis_lw
-    plt.rcParams["xtick.minor.visible"] = is_plot_mticks_x
-    plt.rcParams["ytick.minor.visible"] = is_plot_mticks_y
-
-    # 凡例の見た目設定
-    plt.rcParams["legend.fancybox"] = False  # 丸角OFF
-    plt.rcParams["legend.framealpha"] = 1  # 透明度の指定、0で塗りつぶしなし
-    plt.rcParams["legend.edgecolor"] = "black"  # edgeの色を変更
-
-    return
-
-
-def standardize_legend_sizes(
-    legend: Legend,
-    legend_lines_lw: float | None,
-    legend_scatters_size: float | None,
-) -> None:
-    for idx, handle in enumerate(legend.legend_handles):
-        if isinstance(handle, Line2D) and legend_lines_lw is not None:
-            # Line2Dの場合は線の太さを設定
-            legend.legend_handles[idx].set_linewidth(legend_lines_lw)
-        elif isinstance(handle, PathCollection) and legend_scatters_size is not None:
-            # PathCollection（scatter）の場合はマーカーサイズを設定
-            legend.legend_handles[idx]._sizes = [legend_scatters_size]
-
-    return
-
-
-def set_fig_ax(
-    fig_horizontal_cm: float, fig_vertical_cm: float, dpi: int, is_aspect_equal: bool
-) -> tuple[Figure, Axes]:
-    scaler_cm_to_inch = 1 / 2.54
-
-    fig = plt.figure(
-        figsize=(
-            fig_horizontal_cm * scaler_cm_to_inch,
-            fig_vertical_cm * scaler_cm_to_inch,
-        ),
-        dpi=dpi,
-        layout="constrained",
-    )
-    ax = fig.add_subplot(1, 1, 1)
-    if is_aspect_equal:
-        ax.set_aspect("equal")
-
-    return fig, ax
-
-
-def set_ax_lim(ax: Axes, xmin: float, xmax: float, ymin: float, ymax: float) -> None:
-    ax.set_xlim(xmin, xmax)
-    ax.set_ylim(ymin, ymax)
-
-    return
-
-
-def set_ax_xticks(
-    ax: Axes,
-    space_x_ticks: float,
-    anchor_x_ticks: float,
-    strformatter_x: str | None,
-    is_plot_mticks_x: bool,
-    num_x_mtick: int,
-    xticks_font_size: float,
-) -> None:
-    ax.xaxis.set_major_locator(
-        ticker.MultipleLocator(base=space_x_ticks, offset=anchor_x_ticks)
-    )
-
-    if strformatter_x is not None:
-        ax.xaxis.set_major_formatter(ticker.FormatStrFormatter(strformatter_x))
-
-    if is_plot_mticks_x:
-        ax.xaxis.set_minor_locator(ticker.AutoMinorLocator(n=num_x_mtick + 1))
-
-    ax.tick_params(axis="x", labelsize=xticks_font_size)
-
-    return
-
-
-def set_ax_yticks(
-    ax: Axes,
-    space_y_ticks: float,
-    anchor_y_ticks: float,
-    strformatter_y: str | None,
-    is_plot_mticks_y: bool,
-    num_y_mtick: int,
-    yticks_font_size: float,
-) -> None:
-    ax.yaxis.set_major_locator(
-        ticker.MultipleLocator(base=space_y_ticks, offset=anchor_y_ticks)
-    )
-
-    if strformatter_y is not None:
-        ax.yaxis.set_major_formatter(ticker.FormatStrFormatter(strformatter_y))
-
-    if is_plot_mticks_y:
-        ax.yaxis.set_minor_locator(ticker.AutoMinorLocator(n=num_y_mtick + 1))
-
-    ax.tick_params(axis="y", labelsize=yticks_font_size)
-
-    return
-
-
-def set_ax_xticks_log(
-    ax: Axes,
-    log_base_x: int,
-    log_num_xticks: int | None,
-    is_log_plot_mticks_x: bool,
-    xticks_font_size: float,
-) -> None:
-    ax.set_xscale("log")
-    ax.xaxis.set_major_locator(
-        ticker.LogLocator(base=log_base_x, numticks=log_num_xticks)
-    )
-    ax.xaxis.set_major_formatter(ticker.LogFormatterMathtext(base=log_base_x))
-
-    # フォントサイズ
-    ax.tick_params(axis="x", labelsize=xticks_font_size)
-
-    # 副目盛り
-    if is_log_plot_mticks_x:
-        ax.xaxis.set_minor_locator(ticker.LogLocator(base=log_base_x, subs="auto"))
-    else:
-        ax.xaxis.minorticks_off()
-
-    return
-
-
-def set_ax_yticks_log(
-    ax: Axes,
-    log_base_y: int,
-    log_num_yticks: int | None,
-    is_log_plot_mticks_y: bool,
-    yticks_font_size: float,
-) -> None:
-    ax.set_yscale("log")
-    ax.yaxis.set_major_locator(
-        ticker.LogLocator(base=log_base_y, numticks=log_num_yticks)
-    )
-    ax.yaxis.set_major_formatter(ticker.LogFormatterMathtext(base=log_base_y))
-
-    # フォントサイズ
-    ax.tick_params(axis="y", labelsize=yticks_font_size)
-
-    # 副目盛り
-    if is_log_plot_mticks_y:
-        ax.yaxis.set_minor_locator(ticker.LogLocator(base=log_base_y, subs="auto"))
-    else:
-        ax.yaxis.minorticks_off()
-
-    return
-
-
-def set_xlabel(
-    ax: Axes,
-    xlabel_text: str,
-    xlabel_pos: float,
-    ymin: float,
-    xlabel_offset: float,
-    xlabel_font_size: float,
-) -> None:
-    ax.text(
-        s=xlabel_text,
-        x=xlabel_pos,
-        y=ymin + xlabel_offset,
-        horizontalalignment="center",
-        verticalalignment="top",
-        fontsize=xlabel_font_size,
-        gid="x_title_text",
-    )
-    return
+from matplotlib.backends.backend_pdf import PdfPages
+
+# 共通の処理（plot_common）は，このリポジトリで pip install -e . としてインストールしたものを使う
+from plot_common import (
+    add_pending_plot,
+    commit_outputs,
+    commit_plots,
+    compile_plot_style,
+    estimate_x_offset,
+    gc_output_store,
+    get_legend_handler_map,
+    get_plot_load_executor,
+    init_mpl_process,
+    load_plotdata,
+    pin_ax_position,
+    plot_plotdata,
+    preview_refine_env_name,
+    save_fig,
+    save_fig_pdf,
+    save_fig_raster,
+    save_fig_svg_optimized,
+    set_ax_lim,
+    set_ax_xticks,
+    set_ax_xticks_log,
+    set_ax_yticks,
+    set_ax_yticks_log,
+    set_fig_ax,
+    set_gridline,
+    set_xlabel,
+    set_ylabel,
+    start_background_refine,
+    submit_load_plotdata,
+    use_plot_style,
+)
 
 
-def set_ylabel(
-    ax: Axes,
-    ylabel_text: str,
-    ylabel_pos: float,
-    xmin: float,
-    ylabel_offset: float,
-    ylabel_font_size: float,
-    is_horizontal_ylabel: bool,
+# 長さ等は特記がない限りはポイント単位
+def main(
+    batch_pdf: PdfPages | None = None, batch_output_path_list: list[Path] | None = None
 ) -> None:
-    tmp = ax.text(
-        s=ylabel_text,
-        y=ylabel_pos,
-        x=xmin + ylabel_offset,
-        verticalalignment="center",
-        horizontalalignment="right",
-        fontsize=ylabel_font_size,
-        gid="y_title_text",
-    )
-
-    if not is_horizontal_ylabel:
-        tmp.set_rotation("vertical")
-
-    return
-
+    # 基本設定中のrcParamsの変更（plot_rc）は，この図の描画中だけ適用される
+    plot_rc = {}
 
-def set_gridline(ax: Axes, gridline_style: str) -> None:
-    ax.grid(linestyle=gridline_style)
-    ax.set_axisbelow(True)
-
-    return
-
-
-# 長さ等は特記がない限りはポイント単位
-def main() -> None:
     # ! ---↓基本設定１------------------------------------------------
     # *---出力画像の大きさ [cm]---
     # （参考）A4用紙の縦向きサイズ（縦 × 横）は 29.7 × 21.0[cm]
@@ -261,10 +55,11 @@ def main() -> None:
     # *---全体の見た目の設定----
     axis_lw = 1.7  # 軸線の太さ
     is_aspect_equal = False  # グラフのx軸,y軸のアスペクト比を1:1で固定するか
-    plt.rcParams["xtick.top"] = False  # 上側の軸の目盛りを表示するか
-    plt.rcParams["axes.spines.top"] = False  # 上側の軸を表示するか
-    plt.rcParams["ytick.right"] = False  # 右側の軸の目盛りを表示するか
-    plt.rcParams["axes.spines.right"] = False  # 右側の軸を表示するか
+    is_pin_layout = False  # 軸の位置を出力の種類（ラスター・svg・pdfなど）ごとに1回だけ計算してキャッシュし，同じ設定での2回目以降の実行ではレイアウト計算を省くか（配置は固定しない場合と同じ）
+    plot_rc["xtick.top"] = False  # 上側の軸の目盛りを表示するか
+    plot_rc["axes.spines.top"] = False  # 上側の軸を表示するか
+    plot_rc["ytick.right"] = False  # 右側の軸の目盛りを表示するか
+    plot_rc["axes.spines.right"] = False  # 右側の軸を表示するか
     # *---全体の見た目の設定----
 
     # *---フォント関連---
@@ -275,6 +70,7 @@ def main() -> None:
     yticks_font_size = base_font_size  # y軸目盛りの値のフォントサイズ
     legend_font_size = 14  # 凡例のフォントサイズ
     is_use_TimesNewRoman_in_mathtext = True  # 数式で可能な限りTimes New Romanを使うか（FalseでTeXっぽいフォントを使う）
+    is_use_mathtext_disk_cache = False  # 数式（mathtext）の解析結果をディスクにキャッシュし，次回以降の実行で使いまわすか（png・svgなど全形式．キャッシュはmatplotlibのバージョンごと）
     # *---フォント関連---
 
     # *---グラフの表示範囲の設定---
@@ -289,14 +85,14 @@ def main() -> None:
     anchor_x_ticks = 4.0  # 主目盛りで必ず表示する座標
     space_x_ticks = 2.0  # 主目盛りの間隔
     strformatter_x = "%.1f"  # 主目盛りの値の書式等を変更したいときにいじる（変更しない場合はNoneにする）．
-    plt.rcParams["xtick.major.pad"] = 4.0  # x軸主目盛りから目盛りラベルをどれだけ離すか
-    plt.rcParams["xtick.major.width"] = axis_lw  # x軸主目盛り線の線幅
-    plt.rcParams["xtick.major.size"] = 10  # x軸主目盛り線の長さ
+    plot_rc["xtick.major.pad"] = 4.0  # x軸主目盛りから目盛りラベルをどれだけ離すか
+    plot_rc["xtick.major.width"] = axis_lw  # x軸主目盛り線の線幅
+    plot_rc["xtick.major.size"] = 10  # x軸主目盛り線の長さ
     # -副目盛り-
     is_plot_mticks_x = True  # 副目盛りをプロットするか
     num_x_mtick = 3  # 副目盛りの数
-    plt.rcParams["xtick.minor.width"] = 0.75  # x軸補助目盛り線の線幅
-    plt.rcParams["xtick.minor.size"] = 5  # x軸補助目盛り線の長さ
+    plot_rc["xtick.minor.width"] = 0.75  # x軸補助目盛り線の線幅
+    plot_rc["xtick.minor.size"] = 5  # x軸補助目盛り線の長さ
     # *---目盛りの設定（x軸）---
 
     # *---（対数軸）目盛りの設定（x軸）---
@@ -316,14 +112,14 @@ def main() -> None:
     anchor_y_ticks = 0.0  # 主目盛りで必ず表示する座標
     space_y_ticks = 1000  # 主目盛りの間隔
     strformatter_y = None  # 主目盛りの値の書式等を変更したいときにいじる（変更しない場合はNoneにする）．
-    plt.rcParams["ytick.major.pad"] = 4.0  # y軸主目盛りから目盛りラベルをどれだけ離すか
-    plt.rcParams["ytick.major.width"] = axis_lw  # y軸主目盛り線の線幅
-    plt.rcParams["ytick.major.size"] = 10  # y軸主目盛り線の長さ
+    plot_rc["ytick.major.pad"] = 4.0  # y軸主目盛りから目盛りラベルをどれだけ離すか
+    plot_rc["ytick.major.width"] = axis_lw  # y軸主目盛り線の線幅
+    plot_rc["ytick.major.size"] = 10  # y軸主目盛り線の長さ
     # -副目盛り-
     is_plot_mticks_y = True  # 副目盛りをプロットするか
     num_y_mtick = 4  # 副目盛りの数
-    plt.rcParams["ytick.minor.width"] = 0.75  # y軸補助目盛り線の線幅
-    plt.rcParams["ytick.minor.size"] = 5  # y軸補助目盛り線の長さ
+    plot_rc["ytick.minor.width"] = 0.75  # y軸補助目盛り線の線幅
+    plot_rc["ytick.minor.size"] = 5  # y軸補助目盛り線の長さ
     # *---目盛りの設定（y軸）---
 
     # *---（対数軸）目盛りの設定（x軸）---
@@ -342,12 +138,14 @@ def main() -> None:
     xlabel_text = r"$t \, \mathrm{[s]}$"  # ラベルのテキスト
     xlabel_pos = 10.9  # テキストの中心のx座標
     xlabel_offset = -250  # yminからの，テキストの上端のy座標の変位
+    xlabel_pad = None  # 目盛りの値の下端からの，テキストの上端までの距離 [pt]（指定するとxlabel_offsetの代わりに使う．目盛りの値の大きさから位置を自動で決めるので，データごとの調整が要らない）
     # *---軸ラベルの設定（x軸）---
 
     # *---軸ラベルの設定（y軸）---
     ylabel_text = r"$\mathrm{Pressure \, [N/m^2]}$"  # ラベルのテキスト
     ylabel_pos = 3800  # テキストの中心のy座標
     ylabel_offset = 0.4  # xminからの，テキストの右端のx座標の変位
+    ylabel_pad = None  # 目盛りの値の左端からの，テキストの右端までの距離 [pt]（指定するとylabel_offsetの代わりに使う．目盛りの値の大きさから位置を自動で決めるので，データごとの調整が要らない）
     is_horizontal_ylabel = True  # ラベルを横向きにするか
     # *---軸ラベルの設定（y軸）---
 
@@ -367,10 +165,58 @@ def main() -> None:
         "pdf",
         # "eps",
     ]
+    # ラスター画像（jpeg, pngなど）の出力設定（描画は1回だけ行い，各形式への変換を並列に行う）
+    jpeg_quality = 75  # jpegの画質（1~95．大きいほど高画質・大容量）
+    png_compress_level = 6  # pngの圧縮レベル（0~9．大きいほど小容量・低速）
+    is_raster_optimize = False  # jpeg, pngで追加の最適化を行うか（小容量になるが低速）
+    is_print_raster_benchmark = (
+        False  # 画質・圧縮レベルごとの変換時間と容量の一覧を表示するか
+    )
+    is_png_streamed = False  # pngを（PILを通さず）描画バッファから横長の帯ごとに圧縮しながら書き出すか（ポスターなどの巨大な画像で，PIL画像へのコピー分のメモリを省き，圧縮を並列に行う．描画は通常通り図全体を1回で行うので，描画バッファ（幅×高さ×4バイト）は画像の大きさに比例する）
+    png_band_max_mb = (
+        64  # （pngを帯ごとに書き出す場合）帯1つの圧縮に使うメモリの上限 [MB]
+    )
+    num_png_encode_workers = (
+        1  # （pngを帯ごとに書き出す場合）帯を並列に圧縮するスレッド数
+    )
+    # svgの軽量化（座標の丸め・系列表などの同じ見た目の線の結合・スタイルの共通化．容量と時間を通常の保存と比べて表示する）
+    is_svg_optimized = False  # svgを軽量化して保存するか
+    svg_precision = 3  # （軽量化する場合）座標の小数点以下の桁数
+    is_svg_gzip = False  # （軽量化する場合）gzip圧縮したsvgzとして保存するか
+    # pdfの出力設定
+    pdf_compression = 6  # pdfの圧縮レベル（0~9．下書きは1など小さくすると速く，最終版は9にすると最も小さくなる）
+    is_use_pdf_font_cache = False  # pdfに埋め込むフォントをディスクにキャッシュし，次回以降の実行で使いまわすか（キャッシュはmatplotlibのバージョン・フォントファイルの内容ごと）
     # 保存名（拡張子なし）
     output_filename_withoutextention = "t_pressure_sloshing"
+    # 出力の保存方法
+    is_use_output_store = False  # 出力を内容ごとに1つだけplot_storeフォルダ（全ての図で共有）に保存し，plot_result内のファイルはそこへの読み込み専用のリンクにするか（変わっていない出力は書き込まない．Windowsではリンクでなくコピー）
+    is_gc_output_store = (
+        True  # （リンクにする場合）どの出力からも参照されなくなった古い内容を削除するか
+    )
+    is_fsync_outputs = True  # 保存した出力をfsyncし，停電などでも失われないようにするか（図ごとにまとめて行う）
     # *---画像保存時の設定---
+
+    # *---巨大データの読み込み設定---
+    is_use_minmax_pyramid = False  # 巨大な時系列データを，min/maxピラミッド（初回読み込み時に素データと同じフォルダに作成）から表示範囲と解像度に必要な分だけ読み込むか
+    is_use_lazy_plotdata = False  # 線のデータの読み込みを描画時まで遅らせ，表示範囲内の行だけを（ファイルごとに作る行頭の索引から）読み込むか
+    num_load_workers = (
+        4  # データファイルの読み込みを並行して行う数（1なら1つずつ読み込む）
+    )
+    is_load_in_process = False  # 読み込みを（スレッドでなく）別プロセスで並行して行うか（convertersなどPythonでの処理が多い読み込みのとき）
+    # *---巨大データの読み込み設定---
+
+    # *---プレビュー設定---
+    is_preview = False  # 低dpiのpngだけを先に保存し，extension_listの全形式の保存はバックグラウンドで続けるか（設定の調整中に使う）
+    preview_dpi = 100  # プレビュー画像のdpi
+    # *---プレビュー設定---
     # ! ---↑基本設定１------------------------------------------------
+
+    # バックグラウンドでの全形式の保存時とバッチ実行時はプレビューを行わない
+    if os.environ.get(preview_refine_env_name) or batch_pdf is not None:
+        is_preview = False
+    if is_preview:
+        # プレビューでは，データをプレビュー画像の画素数に合わせて間引いて（min/maxピラミッドから）読み込む
+        is_use_minmax_pyramid = True
     # print_debug
     print("プロット開始")
     print("デバッグ用出力（設定を忘れやすいもの一覧）")
@@ -381,194 +227,413 @@ def main() -> None:
     print(f"- 対数プロットモード（y軸）: {is_log_ticks_y}")
     print(f"- dpi: {dpi} ")
     print(f"- 保存する形式一覧: {extension_list}")
+    print(f"- プレビューモード: {is_preview}")
 
-    set_mplparams_init(
+    init_mpl_process(is_use_mathtext_disk_cache=is_use_mathtext_disk_cache)
+    plot_style = compile_plot_style(
         is_use_TimesNewRoman_in_mathtext=is_use_TimesNewRoman_in_mathtext,
         axis_lw=axis_lw,
         is_plot_mticks_x=is_plot_mticks_x,
         is_plot_mticks_y=is_plot_mticks_y,
+        plot_rc=plot_rc,
     )
 
-    fig, ax = set_fig_ax(
-        fig_horizontal_cm=fig_horizontal_cm,
-        fig_vertical_cm=fig_vertical_cm,
-        dpi=dpi,
-        is_aspect_equal=is_aspect_equal,
-    )
-
-    set_ax_lim(ax=ax, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+    # スタイルはこの図の描画中だけ適用し，描画が終わったら元のrcParamsに戻す
+    with use_plot_style(plot_style):
+        fig, ax = set_fig_ax(
+            fig_horizontal_cm=fig_horizontal_cm,
+            fig_vertical_cm=fig_vertical_cm,
+            dpi=dpi,
+            is_aspect_equal=is_aspect_equal,
+        )
 
-    if is_log_ticks_x:
-        set_ax_xticks_log(
+        set_ax_lim(ax=ax, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+
+        if is_log_ticks_x:
+            set_ax_xticks_log(
+                ax=ax,
+                log_base_x=log_base_x,
+                log_num_xticks=log_num_xticks,
+                is_log_plot_mticks_x=is_log_plot_mticks_x,
+                xticks_font_size=xticks_font_size,
+            )
+        else:
+            set_ax_xticks(
+                ax=ax,
+                space_x_ticks=space_x_ticks,
+                anchor_x_ticks=anchor_x_ticks,
+                strformatter_x=strformatter_x,
+                is_plot_mticks_x=is_plot_mticks_x,
+                num_x_mtick=num_x_mtick,
+                xticks_font_size=xticks_font_size,
+            )
+
+        if is_log_ticks_y:
+            set_ax_yticks_log(
+                ax=ax,
+                log_base_y=log_base_y,
+                log_num_yticks=log_num_yticks,
+                is_log_plot_mticks_y=is_log_plot_mticks_y,
+                yticks_font_size=yticks_font_size,
+            )
+        else:
+            set_ax_yticks(
+                ax=ax,
+                space_y_ticks=space_y_ticks,
+                anchor_y_ticks=anchor_y_ticks,
+                strformatter_y=strformatter_y,
+                is_plot_mticks_y=is_plot_mticks_y,
+                num_y_mtick=num_y_mtick,
+                yticks_font_size=yticks_font_size,
+            )
+
+        set_xlabel(
             ax=ax,
-            log_base_x=log_base_x,
-            log_num_xticks=log_num_xticks,
-            is_log_plot_mticks_x=is_log_plot_mticks_x,
-            xticks_font_size=xticks_font_size,
+            xlabel_text=xlabel_text,
+            xlabel_pos=xlabel_pos,
+            ymin=ymin,
+            xlabel_offset=xlabel_offset,
+            xlabel_pad=xlabel_pad,
+            xlabel_font_size=xlabel_font_size,
         )
-    else:
-        set_ax_xticks(
+        set_ylabel(
             ax=ax,
-            space_x_ticks=space_x_ticks,
-            anchor_x_ticks=anchor_x_ticks,
-            strformatter_x=strformatter_x,
-            is_plot_mticks_x=is_plot_mticks_x,
-            num_x_mtick=num_x_mtick,
-            xticks_font_size=xticks_font_size,
+            ylabel_text=ylabel_text,
+            ylabel_pos=ylabel_pos,
+            xmin=xmin,
+            ylabel_offset=ylabel_offset,
+            ylabel_pad=ylabel_pad,
+            ylabel_font_size=ylabel_font_size,
+            is_horizontal_ylabel=is_horizontal_ylabel,
         )
 
-    if is_log_ticks_y:
-        set_ax_yticks_log(
-            ax=ax,
-            log_base_y=log_base_y,
-            log_num_yticks=log_num_yticks,
-            is_log_plot_mticks_y=is_log_plot_mticks_y,
-            yticks_font_size=yticks_font_size,
+        if is_plot_girdline:
+            set_gridline(ax=ax, gridline_style=gridline_style)
+
+        plotdata_dir_path = Path(__file__).parent / "plot_original_data"
+        num_pixel_x = int(
+            fig_horizontal_cm / 2.54 * (preview_dpi if is_preview else dpi)
+        )  # 出力画像の横方向の画素数
+        # 各ブロックのデータは並行して読み込み，プロットは全ブロックの予約後にまとめて行う
+        plot_load_executor = get_plot_load_executor(
+            num_load_workers=num_load_workers, is_load_in_process=is_load_in_process
         )
-    else:
-        set_ax_yticks(
+        pending_plot_list = []
+        # ! ---↓基本設定２------------------------------------------------
+        # *---データのプロット---
+
+        # -↓データのプロット（これで1ブロック）-
+        # プロットに使うファイル
+        cur_plotdata_filename = "output_sample.dat"
+        x_offset = -0.34  #! データのx座標のずらし量（適宜チューニングかも）
+        is_estimate_x_offset = False  # 上のずらし量の代わりに，実験データとの相互相関から推定したずらし量を使うか
+        if is_estimate_x_offset:
+            # ずらし量の推定に使う，合わせる先のデータのファイル
+            x_offset_fixed_filename = "Kashiwagi.dat"
+            data_moving = load_plotdata(
+                plotdata_path=plotdata_dir_path / cur_plotdata_filename,
+                usecols=(0, 1),
+                is_use_minmax_pyramid=False,
+                xmin=xmin,
+                xmax=xmax,
+                num_pixel_x=num_pixel_x,
+                encoding="utf-8",
+            )
+            data_fixed = load_plotdata(
+                plotdata_path=plotdata_dir_path / x_offset_fixed_filename,
+                usecols=(0, 1),
+                is_use_minmax_pyramid=False,
+                xmin=xmin,
+                xmax=xmax,
+                num_pixel_x=num_pixel_x,
+                encoding="utf-8",
+            )
+            x_offset = estimate_x_offset(
+                x_moving=data_moving[:, 0],
+                y_moving=data_moving[:, 1],
+                x_fixed=data_fixed[:, 0],
+                y_fixed=data_fixed[:, 1],
+                max_abs_offset=2.0,  # ずらし量の絶対値の上限（周期的なデータで1周期ずれた位置を選ばないように）
+            )
+            print(f"推定したx座標のずらし量: {x_offset:.4f}")
+        # データ読み込み
+        data = submit_load_plotdata(
+            executor=plot_load_executor,
+            plotdata_path=plotdata_dir_path / cur_plotdata_filename,
+            usecols=(
+                0,
+                1,
+            ),  # プロットするデータがそれぞれ何列目か指定（0始まりで）
+            # delimiter=",",  # 列方向のデータの区切り文字を指定
+            # comments="//",  # 行頭などにあるコメント文の開始文字を指定
+            # skiprows=4,  # 無視する先頭行の数
+            # max_rows=9,  # データの先頭からいくつ列を読み込むか
+            transform_list=[
+                # {"op": "scale", "col": 0, "factor": 1e-3},  # 列に倍率をかける（単位換算など）
+                {
+                    "op": "offset",
+                    "col": 0,
+                    "value": x_offset,
+                },  # データのx座標をずらしてプロット
+                # {"op": "derivative", "col": 1, "x_col": 0},  # 列をx_col列についての微分にする
+                # {"op": "moving_average", "col": 1, "window": 5},  # 列を中心移動平均（点数）にする
+                # {"op": "resample", "x_col": 0, "start": 0, "stop": 20, "num": 1001},  # x_col列を等間隔の格子にし，他の列を線形補間する
+            ],  # 読み込んだデータに上から順に適用する変換（colは読み込んだ後の列番号．同じファイル・変換の結果はキャッシュされる）
+            # 以下は基本いじらなくてoK
+            encoding="utf-8",  # これがないとtxtのときとかにエンコードがおかしくなる？
+            is_use_minmax_pyramid=is_use_minmax_pyramid,
+            xmin=xmin,
+            xmax=xmax,
+            num_pixel_x=num_pixel_x,
+            is_lazy=is_use_lazy_plotdata,
+        )
+        # プロット（線）
+        add_pending_plot(
+            pending_plot_list=pending_plot_list,
+            plot_func=plot_plotdata,
             ax=ax,
-            space_y_ticks=space_y_ticks,
-            anchor_y_ticks=anchor_y_ticks,
-            strformatter_y=strformatter_y,
-            is_plot_mticks_y=is_plot_mticks_y,
-            num_y_mtick=num_y_mtick,
-            yticks_font_size=yticks_font_size,
+            data=data,
+            color="red",  # 線の色
+            linewidth=1.0,  # 線の太さ
+            linestyle="-",  # 線のスタイル（破線などはここで）
+            label="Numerical",  # 凡例に使用するラベル
+            zorder=2.2,  # 重ね順の調整．この値が大きいほど手前にプロットされる（開区間(2,3)内で設定）
+            # 以下は基本いじらなくてOK
+            gid=cur_plotdata_filename,
         )
-
-    set_xlabel(
-        ax=ax,
-        xlabel_text=xlabel_text,
-        xlabel_pos=xlabel_pos,
-        ymin=ymin,
-        xlabel_offset=xlabel_offset,
-        xlabel_font_size=xlabel_font_size,
-    )
-    set_ylabel(
-        ax=ax,
-        ylabel_text=ylabel_text,
-        ylabel_pos=ylabel_pos,
-        xmin=xmin,
-        ylabel_offset=ylabel_offset,
-        ylabel_font_size=ylabel_font_size,
-        is_horizontal_ylabel=is_horizontal_ylabel,
-    )
-
-    if is_plot_girdline:
-        set_gridline(ax=ax, gridline_style=gridline_style)
-
-    plotdata_dir_path = Path(__file__).parent / "plot_original_data"
-    # ! ---↓基本設定２------------------------------------------------
-    # *---データのプロット---
-
-    # -↓データのプロット（これで1ブロック）-
-    # プロットに使うファイル
-    cur_plotdata_filename = "output_sample.dat"
-    # データ読み込み
-    data = np.loadtxt(
-        plotdata_dir_path / cur_plotdata_filename,
-        usecols=(
-            0,
-            1,
-        ),  # プロットするデータがそれぞれ何列目か指定（0始まりで）
-        # delimiter=",",  # 列方向のデータの区切り文字を指定
-        # comments="//",  # 行頭などにあるコメント文の開始文字を指定
-        # skiprows=4,  # 無視する先頭行の数
-        # max_rows=9,  # データの先頭からいくつ列を読み込むか
-        # 以下は基本いじらなくてoK
-        encoding="utf-8",  # これがないとtxtのときとかにエンコードがおかしくなる？
-    )
-    # プロット（線）
-    ax.plot(
-        data[:, 0]
-        - 0.34,  #! データのx座標をずらしてプロット（この値は適宜チューニングかも）
-        data[:, 1],
-        color="red",  # 線の色
-        linewidth=1.0,  # 線の太さ
-        linestyle="-",  # 線のスタイル（破線などはここで）
-        label="Numerical",  # 凡例に使用するラベル
-        zorder=2.2,  # 重ね順の調整．この値が大きいほど手前にプロットされる（開区間(2,3)内で設定）
-        # 以下は基本いじらなくてOK
-        gid=cur_plotdata_filename,
-    )
-
-    print(f"データプロット完了: {cur_plotdata_filename}")
-    # -↑データのプロット（これで1ブロック）-
-
-    # -↓データのプロット（これで1ブロック）-
-    # プロットに使うファイル
-    cur_plotdata_filename = "Kashiwagi.dat"
-    # データ読み込み
-    data = np.loadtxt(
-        plotdata_dir_path / cur_plotdata_filename,
-        usecols=(
-            0,
-            1,
-        ),  # プロットするデータがそれぞれ何列目か指定（0始まりで）
-        # delimiter=",",  # 列方向のデータの区切り文字を指定
-        # comments="//",  # 行頭などにあるコメント文の開始文字を指定
-        # skiprows=4,  # 無視する先頭行の数
-        # max_rows=9,  # データの先頭からいくつ列を読み込むか
-        # 以下は基本いじらなくてoK
-        encoding="utf-8",  # これがないとtxtのときとかにエンコードがおかしくなる？
-    )
-    # プロット（線）
-    ax.plot(
-        data[:, 0],
-        data[:, 1],
-        color="black",  # 線の色
-        linewidth=1.5,  # 線の太さ
-        linestyle="--",  # 線のスタイル（破線などはここで）
-        label="Experiment",  # 凡例に使用するラベル
-        zorder=2.2,  # 重ね順の調整．この値が大きいほど手前にプロットされる（開区間(2,3)内で設定）
-        # 以下は基本いじらなくてOK
-        gid=cur_plotdata_filename,
-    )
-
-    print(f"データプロット完了: {cur_plotdata_filename}")
-    # -↑データのプロット（これで1ブロック）-
-
-    # *---データのプロット---
-
-    # *---凡例の設定---
-    is_plot_legend = True  # 凡例をプロットするか
-
-    if is_plot_legend:
-        legend = ax.legend(
-            loc="upper right",  # legendboxのどの位置をbbox_to_anchorで固定するか（公式リファレンス参照）
-            bbox_to_anchor=(
-                1.0,
-                1.24,
-                # 0.6,
-                # 1,
-            ),  # それぞれ((locで固定するx), (~~するy), (legendboxの横幅), (これはあまり意味ない？))
-            # mode="expand",  # bbox_to_anchorの3,4個目の引数を指定するとき以外はコメントアウト
-            ncol=1,  # 凡例をいくつ横並びで置くか
+        # -↑データのプロット（これで1ブロック）-
+
+        # -↓データのプロット（これで1ブロック）-
+        # プロットに使うファイル
+        cur_plotdata_filename = "Kashiwagi.dat"
+        # データ読み込み
+        data = submit_load_plotdata(
+            executor=plot_load_executor,
+            plotdata_path=plotdata_dir_path / cur_plotdata_filename,
+            usecols=(
+                0,
+                1,
+            ),  # プロットするデータがそれぞれ何列目か指定（0始まりで）
+            # delimiter=",",  # 列方向のデータの区切り文字を指定
+            # comments="//",  # 行頭などにあるコメント文の開始文字を指定
+            # skiprows=4,  # 無視する先頭行の数
+            # max_rows=9,  # データの先頭からいくつ列を読み込むか
+            transform_list=[
+                # {"op": "scale", "col": 0, "factor": 1e-3},  # 列に倍率をかける（単位換算など）
+                # {"op": "offset", "col": 0, "value": -0.34},  # 列に値を加える（座標をずらすなど）
+                # {"op": "derivative", "col": 1, "x_col": 0},  # 列をx_col列についての微分にする
+                # {"op": "moving_average", "col": 1, "window": 5},  # 列を中心移動平均（点数）にする
+                # {"op": "resample", "x_col": 0, "start": 0, "stop": 20, "num": 1001},  # x_col列を等間隔の格子にし，他の列を線形補間する
+            ],  # 読み込んだデータに上から順に適用する変換（colは読み込んだ後の列番号．同じファイル・変換の結果はキャッシュされる）
+            # 以下は基本いじらなくてoK
+            encoding="utf-8",  # これがないとtxtのときとかにエンコードがおかしくなる？
+            is_use_minmax_pyramid=is_use_minmax_pyramid,
+            xmin=xmin,
+            xmax=xmax,
+            num_pixel_x=num_pixel_x,
+            is_lazy=is_use_lazy_plotdata,
+        )
+        # プロット（線）
+        add_pending_plot(
+            pending_plot_list=pending_plot_list,
+            plot_func=plot_plotdata,
+            ax=ax,
+            data=data,
+            color="black",  # 線の色
+            linewidth=1.5,  # 線の太さ
+            linestyle="--",  # 線のスタイル（破線などはここで）
+            label="Experiment",  # 凡例に使用するラベル
+            zorder=2.2,  # 重ね順の調整．この値が大きいほど手前にプロットされる（開区間(2,3)内で設定）
             # 以下は基本いじらなくてOK
-            borderaxespad=0,
-            prop={"size": legend_font_size},
+            gid=cur_plotdata_filename,
         )
-
-        standardize_legend_sizes(
-            legend=legend,
-            legend_lines_lw=None,  # 凡例のlineの太さを統一（しないときはNone）
-            legend_scatters_size=None,  # 凡例のscatterの大きさを統一（しないときはNone）
+        # -↑データのプロット（これで1ブロック）-
+
+        # *---データのプロット---
+
+        # 予約したプロットを，読み込みを待ちながら図に追加する（いじらなくてOK）
+        commit_plots(pending_plot_list=pending_plot_list)
+
+        # *---凡例の設定---
+        is_plot_legend = True  # 凡例をプロットするか
+
+        if is_plot_legend:
+            legend = ax.legend(
+                loc="upper right",  # legendboxのどの位置をbbox_to_anchorで固定するか（公式リファレンス参照）
+                bbox_to_anchor=(
+                    1.0,
+                    1.24,
+                    # 0.6,
+                    # 1,
+                ),  # それぞれ((locで固定するx), (~~するy), (legendboxの横幅), (これはあまり意味ない？))
+                # mode="expand",  # bbox_to_anchorの3,4個目の引数を指定するとき以外はコメントアウト
+                ncol=1,  # 凡例をいくつ横並びで置くか
+                handler_map=get_legend_handler_map(
+                    legend_lines_lw=None,  # 凡例のlineの太さを統一（しないときはNone）
+                    legend_scatters_size=None,  # 凡例のscatterの大きさを統一（しないときはNone）
+                ),  # 凡例のline・scatterの大きさ（凡例を作る時点で統一する）
+                # 以下は基本いじらなくてOK
+                borderaxespad=0,
+                prop={"size": legend_font_size},
+            )
+
+            # いじらなくてOK
+            legend.set_zorder(1000000)
+        # *---凡例の設定---
+        # ! ---↑基本設定２------------------------------------------------
+
+        # 軸の位置を固定する場合の，位置のキャッシュの保存先（固定しない場合はNone）
+        # プレビューでも，図は本番のdpiで作ってレイアウトを固定し，保存時だけdpiを下げる
+        # （本番のラスター画像も同じdpiでレイアウトを計算するので，プレビューと同じ配置になる）
+        layout_cache_dir_path = (
+            Path(mpl.get_cachedir()) / "layout_cache"
+            if is_pin_layout or is_preview
+            else None
         )
+        # 設定はすべてこのファイルに書かれているので，ファイルの内容をキャッシュのキーにする
+        layout_key = {"plot_py": Path(__file__).read_text(encoding="utf-8")}
+
+        output_dir_path = Path(__file__).parent / "plot_result"
+        output_dir_path.mkdir(exist_ok=True)
+        # 内容ごとに1つだけ保存するストア（複数の図で共有する）
+        output_store_dir_path = (
+            Path(__file__).parent.parent / "plot_store" if is_use_output_store else None
+        )
+        # この図の出力のうち，一時ファイルに書き出したが，まだ最終的なパスに置いていないもの
+        pending_output_list = []
+
+        if is_preview:
+            preview_path = (
+                output_dir_path / f"{output_filename_withoutextention}_preview.png"
+            )
+            # プレビューも一時ファイルに書き出してから置く（書きかけのプレビューが残らないように）
+            # （調整中に何度も上書きするものなので，ストアには入れない）
+            with pin_ax_position(
+                fig=fig,
+                ax=ax,
+                output_kind="raster",
+                layout_cache_dir_path=layout_cache_dir_path,
+                layout_key=layout_key,
+            ):
+                save_fig(
+                    fig=fig,
+                    output_path=preview_path,
+                    output_store_dir_path=None,
+                    pending_output_list=pending_output_list,
+                    dpi=preview_dpi,
+                )
+            commit_outputs(
+                pending_output_list=pending_output_list,
+                output_store_dir_path=None,
+                is_fsync=is_fsync_outputs,
+            )
+            print(f"プレビュー保存完了: {preview_path.name}")
+
+            refine_log_path = (
+                output_dir_path / f"{output_filename_withoutextention}_refine.log"
+            )
+            start_background_refine(
+                plot_py_path=Path(__file__).resolve(), log_path=refine_log_path
+            )
+            print(
+                f"全形式の保存をバックグラウンドで開始（ログ: {refine_log_path.name}）"
+            )
+            print("プロット終了")
+
+            return
+
+        raster_extension_list = [
+            extension
+            for extension in extension_list
+            if extension in ("png", "jpg", "jpeg", "tif", "tiff", "webp")
+        ]
+        if raster_extension_list:
+            with pin_ax_position(
+                fig=fig,
+                ax=ax,
+                output_kind="raster",
+                layout_cache_dir_path=layout_cache_dir_path,
+                layout_key=layout_key,
+            ):
+                save_fig_raster(
+                    fig=fig,
+                    output_path_list=[
+                        output_dir_path
+                        / f"{output_filename_withoutextention}.{extension}"
+                        for extension in raster_extension_list
+                    ],
+                    jpeg_quality=jpeg_quality,
+                    png_compress_level=png_compress_level,
+                    is_raster_optimize=is_raster_optimize,
+                    is_print_raster_benchmark=is_print_raster_benchmark,
+                    is_png_streamed=is_png_streamed,
+                    png_band_max_mb=png_band_max_mb,
+                    num_png_encode_workers=num_png_encode_workers,
+                    output_store_dir_path=output_store_dir_path,
+                    pending_output_list=pending_output_list,
+                )
+            print(f"画像保存完了: {', '.join(raster_extension_list)}")
+
+        for extension in extension_list:
+            if extension in raster_extension_list:
+                continue
+
+            output_path = (
+                output_dir_path / f"{output_filename_withoutextention}.{extension}"
+            )
+            with pin_ax_position(
+                fig=fig,
+                ax=ax,
+                output_kind=extension,
+                layout_cache_dir_path=layout_cache_dir_path,
+                layout_key=layout_key,
+            ):
+                if extension == "svg" and is_svg_optimized:
+                    save_fig_svg_optimized(
+                        fig=fig,
+                        output_path=output_path,
+                        svg_precision=svg_precision,
+                        is_svg_gzip=is_svg_gzip,
+                        output_store_dir_path=output_store_dir_path,
+                        pending_output_list=pending_output_list,
+                    )
+                elif extension == "pdf":
+                    save_fig_pdf(
+                        fig=fig,
+                        output_path=output_path,
+                        pdf_compression=pdf_compression,
+                        is_use_pdf_font_cache=is_use_pdf_font_cache,
+                        output_store_dir_path=output_store_dir_path,
+                        pending_output_list=pending_output_list,
+                    )
+                else:
+                    save_fig(
+                        fig=fig,
+                        output_path=output_path,
+                        output_store_dir_path=output_store_dir_path,
+                        pending_output_list=pending_output_list,
+                    )
+            print(f"画像保存完了: {extension}")
+
+        # 一時ファイルに書き出した出力をまとめて最終的なパスに置く
+        # バッチ実行時は，fsyncはバッチの最後に全図分をまとめて行う（置いたパスをbatch_output_path_listに追加しておく）
+        committed_path_list = commit_outputs(
+            pending_output_list=pending_output_list,
+            output_store_dir_path=output_store_dir_path,
+            is_fsync=is_fsync_outputs and batch_output_path_list is None,
+        )
+        if batch_output_path_list is not None:
+            batch_output_path_list.extend(committed_path_list)
 
-        # いじらなくてOK
-        legend.set_zorder(1000000)
-    # *---凡例の設定---
-    # ! ---↑基本設定２------------------------------------------------
-
-    output_dir_path = Path(__file__).parent / "plot_result"
-    output_dir_path.mkdir(exist_ok=True)
+        if output_store_dir_path is not None and is_gc_output_store:
+            gc_output_store(output_store_dir_path=output_store_dir_path)
 
-    for extension in extension_list:
-        fig.savefig(output_dir_path / f"{output_filename_withoutextention}.{extension}")
-        print(f"画像保存完了: {extension}")
+        if batch_pdf is not None:
+            # バッチ実行時は，全図をまとめた1つのpdfにもページとして追加する
+            batch_pdf.savefig(fig)
+            print("バッチ用pdfへの追加完了")
 
-    plt.close()
-    print("プロット終了")
+        print("プロット終了")
 
     return
 
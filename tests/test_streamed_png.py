@@ -0,0 +1,56 @@
+import io
+
+import matplotlib as mpl
+import numpy as np
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from plot_common import write_png_streamed
+
+
+def make_fig() -> Figure:
+    # 帯の境目をまたぐ破線・細い線・塗りつぶしを含む図
+    fig = Figure(figsize=(4, 3), dpi=150, layout="constrained")
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    x = np.linspace(0, 10, 5000)
+    ax.plot(x, np.sin(x), linestyle="--", linewidth=1.5)
+    ax.plot(x, np.cos(3 * x), linestyle=":", linewidth=0.8)
+    ax.plot(x, 0.5 * np.sin(7 * x), linestyle="-.", linewidth=1.0)
+    ax.fill_between(x, -0.2, 0.2 * np.cos(x), alpha=0.3)
+    ax.set_xlabel("x")
+    ax.set_ylabel("y")
+
+    return fig
+
+
+@pytest.mark.parametrize(
+    ("png_band_max_mb", "num_png_encode_workers"),
+    [(0.01, 1), (0.05, 1), (0.01, 4), (64, 1)],
+)
+def test_streamed_png_matches_savefig(
+    tmp_path, png_band_max_mb, num_png_encode_workers
+):
+    fig = make_fig()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    expected = mpl.image.imread(io.BytesIO(buf.getvalue()))
+
+    canvas = fig.canvas
+    canvas.draw()
+    output_path = tmp_path / "streamed.png"
+    write_png_streamed(
+        rgba=canvas.buffer_rgba(),
+        dpi=fig.dpi,
+        output_path=output_path,
+        png_band_max_mb=png_band_max_mb,
+        num_png_encode_workers=num_png_encode_workers,
+    )
+    actual = mpl.image.imread(output_path)
+
+    width = expected.shape[1]
+    if png_band_max_mb < 1:
+        # 複数の帯に分かれていること
+        assert png_band_max_mb * 1024**2 // (width * 4) < expected.shape[0]
+    np.testing.assert_array_equal(actual, expected)